@@ -2,9 +2,10 @@ from airflow import DAG
 from airflow.operators.python_operator import PythonOperator
 from datetime import datetime, timedelta
 import requests
-import snowflake.connector
 import pandas as pd
 import os
+from connections import snowflake_connection_manager, local_connection_manager, LocalConnection
+from rate_limiter import RateLimiter, QuotaBudget, API_MAX_REQUESTS_PER_SECOND
 
 
 default_args = {
@@ -22,166 +23,436 @@ dag = DAG(
     'stackoverflow_weekly_ingestion',
     default_args=default_args,
     description='Retrieve StackOverflow questions and answers from the last week and load them into Snowflake',
-    schedule_interval='0 9 * * 1' # Cron expression for every Monday at 9:00 AM
+    schedule_interval='0 9 * * 1', # Cron expression for every Monday at 9:00 AM
+    max_active_runs=1 # The runs share the staging table of the load task
 )
 
 
-def fetch_stackoverflow_data():
+# Snowflake sessions of the task being run : every Airflow task runs in its own process, so the sessions are only reused by the statements
+# of one task, never shared between tasks (set SNOWFLAKE_LOCAL_DB to run the tasks on a local SQLite file instead)
+_manager = None
+
+def get_connection_manager():
+    global _manager
+    if _manager is None:
+        if os.getenv('SNOWFLAKE_LOCAL_DB'):
+            _manager = local_connection_manager(os.getenv('SNOWFLAKE_LOCAL_DB'))
+        else:
+            _manager = snowflake_connection_manager(
+                os.getenv('SNOWFLAKE_USER'),
+                os.getenv('SNOWFLAKE_PASSWORD'),
+                os.getenv('SNOWFLAKE_ACCOUNT'),
+                os.getenv('SNOWFLAKE_WH'),
+                os.getenv('SNOWFLAKE_DB'),
+                os.getenv('SNOWFLAKE_SCHEMA')
+            )
+    return _manager
+
+
+# Number of ids of a /questions/{ids} call (the API maximum), and the fields of the questions
+QUESTIONS_BATCH_SIZE = 100
+QUESTIONS_FILTER = '!LbeL0UFTwm63R2NM(EP17R'
+
+# The week is fetched by WEEK_DAYS mapped tasks (one per day), FETCH_PARALLELISM of them at a time
+WEEK_DAYS = 7
+FETCH_PARALLELISM = int(os.getenv('STACKOVERFLOW_FETCH_PARALLELISM', 3))
+
+# StackExchange calls of the tasks : one rate limiter (token bucket, backoff, retries, timeouts) and one pooled http session per process,
+# the calls stop once the remaining daily quota reaches STACKEXCHANGE_QUOTA_LIMIT
+_limiter = None
+_http_session = None
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        # The fetch tasks that run at the same time share the requests per second allowed to the DAG
+        _limiter = RateLimiter(rate=float(os.getenv('STACKEXCHANGE_REQUESTS_PER_SECOND', 20)) / FETCH_PARALLELISM,
+                               capacity=max(1, API_MAX_REQUESTS_PER_SECOND // FETCH_PARALLELISM))
+    return _limiter
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        _http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return _http_session
+
+
+def get_quota_budget():
+    return QuotaBudget(int(os.getenv('STACKEXCHANGE_QUOTA_LIMIT', 0)))
+
+
+"""
+Fetches the questions of a list of ids with one /questions/{ids} call per batch of QUESTIONS_BATCH_SIZE ids
+and returns them as a dict question_id -> question, with whether every batch was fetched (False when the quota budget
+stopped the fetch early, the ids of the skipped batches are then missing) :
+    - A call that fails raises a RuntimeError, so the load task fails and is retried instead of loading answers without questions
+"""
+
+def fetch_questions(question_ids, api_key, budget=None):
+    limiter = get_limiter()
+    budget = budget or get_quota_budget()
+    question_ids = list(dict.fromkeys(int(question_id) for question_id in question_ids))
+    params = {
+        'key':api_key,
+        'site': 'stackoverflow',
+        'pagesize': QUESTIONS_BATCH_SIZE,
+        'filter': QUESTIONS_FILTER
+    }
 
-    api_key = os.getenv('STACKEXCHANGE_API_KEY')
-    last_week = int((datetime.now() - timedelta(days=7)).timestamp())
-    api_url = "https://api.stackexchange.com/2.3/answers"
+    questions = {}
+    complete = True
+    for i in range(0, len(question_ids), QUESTIONS_BATCH_SIZE):
+        if budget.exhausted():
+            print(f"Quota limit reached, {len(question_ids) - i} questions not fetched")
+            complete = False
+            break
+
+        batch = question_ids[i:i + QUESTIONS_BATCH_SIZE]
+        url = "https://api.stackexchange.com/2.3/questions/" + ';'.join(map(str, batch))
+        payload = limiter.get(get_http_session(), url, params)
+        if limiter.quota_remaining is not None:
+            budget.update(limiter.quota_remaining)
+        if payload is None:
+            raise RuntimeError(f"Encountered an error while fetching the questions {i} to {i + len(batch)} of {len(question_ids)}")
+
+        for item in payload.get('items', []):
+            questions[item['question_id']] = item
+
+    print(f"{len(questions)} of {len(question_ids)} questions fetched, quota remaining : {limiter.quota_remaining}")
+    return questions, complete
+
+
+# Folder of the files written by the fetch task and read by the load task
+DATA_DIR = os.getenv('STACKOVERFLOW_WEEKLY_DIR', '/tmp/stackoverflow_weekly')
+ANSWERS_FILTER = '!)qXWnHAIkwK7PiwNONT6'  # Custom filter to include needed fields
+
+
+"""
+Generator of the pages of answers created between from_date and to_date :
+    - Follows has_more page after page through the rate limiter and the pooled session
+    - Raises when a call fails (after the retries of the rate limiter), so that Airflow retries the slice instead of keeping
+      a truncated partition
+    - Stops early, with a message, when the remaining quota reaches the limit of the budget
+    - Yields the items of each page as soon as it arrives with its has_more flag, so the caller never holds more than one page
+      and knows whether the answers were all fetched
+"""
+
+def iter_answer_pages(from_date, to_date, api_key, budget=None):
+    limiter = get_limiter()
+    budget = budget or get_quota_budget()
     params = {
         'key':api_key,
         'pagesize':100,
-        'fromdate': last_week,
-        'todate': int(datetime.now().timestamp()),
+        'fromdate': from_date,
+        'todate': to_date,
         'order': 'asc',
         'sort': 'creation',
         'site': 'stackoverflow',
-        'filter': '!)qXWnHAIkwK7PiwNONT6'  # Custom filter to include needed fields
+        'filter': ANSWERS_FILTER
     }
 
+    page = 1
+    while True:
+        if budget.exhausted():
+            print(f"Quota limit reached, the answers after page {page - 1} are not fetched")
+            return
 
-    response = requests.get(api_url, params=params)
-    data = response.json()
+        payload = limiter.get(get_http_session(), "https://api.stackexchange.com/2.3/answers", dict(params, page=page))
+        if limiter.quota_remaining is not None:
+            budget.update(limiter.quota_remaining)
+        if payload is None:
+            raise RuntimeError(f"Encountered an error while fetching the page {page} of answers")
 
-    # Filtering questions to include only those with an accepted answer
-    answers = []
-    for item in data['items']:
-        if item['is_accepted'] == True:
-            answers.append(item)
+        yield payload.get('items', []), bool(payload.get('has_more'))
+        if not payload.get('has_more'):
+            return
+        page += 1
 
-    return answers
 
+# Fields of the accepted answers kept in the file of the fetch task
+ANSWER_COLUMNS = [('answer_id', 'int64'), ('question_id', 'int64'), ('creation_date', 'int64'), ('score', 'int64'), ('up_vote_count', 'int64'),
+                  ('body_markdown', 'string')]
 
+# Number of answers read at once by the load task
+READ_BATCH_SIZE = 10000
 
 
+"""
+Fetches every answer of one day of the last week page by page (a mapped task per day, see WEEK_DAYS) and writes the accepted ones
+to a compressed parquet partition as they arrive (one row group per page), returns its uri, its number of rows and whether
+the day is complete (False when the quota budget stopped the fetch early) : the only values that go through XCom
 
-def load_data_to_snowflake(**kwargs):
-    ti = kwargs['ti']
-    # Getting the questions data from the previous task
-    answers = ti.xcom_pull(task_ids='fetch_stackoverflow_data')
-    api_key = os.getenv('STACKEXCHANGE_API_KEY')
-
-
-    records = []
-    for answer in answers:
-        record = {
-            'tags': '',
-            'title': '',
-            'question_body': '',
-            'question_id': answer['question_id'],
-            'answer_creation_date': answer['creation_date'],
-            'question_creation_date':'',
-            'question_score':'',
-            'favorite_count':'',
-            'question_upvote_count':'',
-            'view_count':'',
-            'answer_body': answer['body_markdown'], 
-            'answer_upvote_count':answer['up_vote_count'],
-            'answer_score':answer['score'],
-            'answer_id':answer['answer_id']
-        }
-        # Fetching the accepted answer
-        question_url = "https://api.stackexchange.com/2.3/questions/" + str(answer['question_id'])
-        question_params = {
-            'key':api_key,
-            'site': 'stackoverflow',
-            'filter': '!LbeL0UFTwm63R2NM(EP17R'
-        }
-        question_response = requests.get(question_url, params=question_params)
-        question_data = question_response.json()
-        if 'items' in question_data and len(question_data['items']) > 0:
-            record['question_body'] = question_data['items'][0]['body_markdown']
-            record['question_upvote_count'] = question_data['items'][0]['up_vote_count']
-            record['question_score'] = question_data['items'][0]['score']
-            record['question_creation_date'] = question_data['items'][0]['creation_date']
-            record['title'] = question_data['items'][0]['title']
-            record['tags'] = ','.join(question_data['items'][0]['tags'])
-            record['favorite_count'] = question_data['items'][0]['favorite_count']
-            record['view_count'] = question_data['items'][0]['view_count']
-
-        records.append(record)
-
-    df = pd.DataFrame(records)
-
-    snowflake_user = os.getenv('SNOWFLAKE_USER')
-    snowflake_password = os.getenv('SNOWFLAKE_PASSWORD')
-    snowflake_acc = os.getenv('SNOWFLAKE_ACCOUNT')
-    snowflake_wh = os.getenv('SNOWFLAKE_WH')
-    snowflake_db = os.getenv('SNOWFLAKE_DB')
-    snowflake_schema = os.getenv('SNOWFLAKE_SCHEMA')
-
-    conn = snowflake.connector.connect(
-        user=snowflake_user,
-        password=snowflake_password,
-        account=snowflake_acc,
-        warehouse=snowflake_wh,
-        database=snowflake_db,
-        schema=snowflake_schema
-    )
-
-    cursor = conn.cursor()
-
-    # Truncate the table to remove old data and replace with new data of the last week
-    cursor.execute("""
-        Truncate TABLE stackoverflow_weekly
-    """)
-
-
-    for index, row in df.iterrows():
-        print(row)
-        cursor.execute("""
-            INSERT INTO stackoverflow_weekly (tags, title, question_body, answer_body, question_id, question_creation_date, question_score, favorite_count, question_upvote_count, view_count, answer_upvote_count, answer_score, answer_id, answer_creation_date)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (row['tags'], row['title'], row['question_body'], row['answer_body'], row['question_id'], row['question_creation_date'],
-              row['question_score'], row['favorite_count'], row['question_upvote_count'], row['view_count'],
-            row['answer_upvote_count'], row['answer_score'], row['answer_id'], row['answer_creation_date']))
-
-    cursor.close()
-    conn.close()
+The day is taken back from the end of the data interval of the run, so a retried slice fetches the same window again
+"""
 
+def fetch_stackoverflow_data(day=0, **kwargs):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
 
+    api_key = os.getenv('STACKEXCHANGE_API_KEY')
+    end = kwargs.get('data_interval_end') or datetime.now()
+    to_date = int((end - timedelta(days=day)).timestamp())
+    from_date = int((end - timedelta(days=day + 1)).timestamp())
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, 'answers_' + kwargs.get('ts_nodash', end.strftime('%Y%m%dT%H%M%S')) + '_day' + str(day) + '.parquet')
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in ANSWER_COLUMNS])
+
+    # The /answers endpoint cannot filter on is_accepted : the accepted answers are kept page by page
+    pages = 0
+    accepted = 0
+    has_more = True
+    with pq.ParquetWriter(path + '.part', schema, compression='zstd') as writer:
+        for items, has_more in iter_answer_pages(from_date, to_date, api_key):
+            pages += 1
+            items = [item for item in items if item['is_accepted'] == True]
+            if items:
+                writer.write_table(pa.Table.from_pylist(items, schema=schema))
+                accepted += len(items)
+    os.replace(path + '.part', path)
+
+    print(f"{accepted} accepted answers in {pages} pages written to {path}" + ("" if not has_more else ", the quota stopped the fetch before the end of the day"))
+    return {'uri': path, 'rows': accepted, 'day': day, 'complete': not has_more}
+
+
+"""
+Reads the accepted answers written by fetch_stackoverflow_data() by batches of READ_BATCH_SIZE answers (lists of dicts),
+or only the given columns
+"""
+
+def read_answers(uri, columns=None):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(uri).iter_batches(batch_size=READ_BATCH_SIZE, columns=columns):
+        yield batch.to_pylist()
+
+
+# Columns of stackoverflow_weekly in the order of the inserts, and the NUMBER ones
+WEEKLY_COLUMNS = ['tags', 'title', 'question_body', 'answer_body', 'question_id', 'question_creation_date', 'question_score', 'favorite_count',
+                  'question_upvote_count', 'view_count', 'answer_upvote_count', 'answer_score', 'answer_id', 'answer_creation_date']
+NUMBER_COLUMNS = ['question_id', 'question_creation_date', 'question_score', 'favorite_count', 'question_upvote_count', 'view_count',
+                  'answer_upvote_count', 'answer_score', 'answer_id', 'answer_creation_date']
+
+# Number of rows sent by one executemany on the local stand-in (Snowflake gets the rows with write_pandas, see stage_records())
+LOAD_BATCH_SIZE = 10000
+
+
+"""
+Types the records before they are loaded :
+    - The NUMBER columns become nullable integers, an empty string (question not found) becomes NULL and a value that is not a number
+      becomes NULL with a warning
+    - The text columns become strings ('' when missing)
+    - The rows without answer_id or question_id are dropped, an answer_id is kept once
+    - The answers whose question was not fetched (no question_creation_date) are dropped : loaded as blank rows with a NULL
+      view_count, they would come first in the ORDER BY VIEW_COUNT DESC of the newsletter
+"""
+
+def validate_records(df):
+    df = df.reindex(columns=WEEKLY_COLUMNS)
+
+    for column in NUMBER_COLUMNS:
+        values = df[column].replace('', None)
+        numbers = pd.to_numeric(values, errors='coerce')
+        invalid = int((numbers.isna() & values.notna()).sum())
+        if invalid:
+            print(f"{invalid} values of {column} are not numbers, they are loaded as NULL")
+        df[column] = numbers.round().astype('Int64')
+
+    for column in WEEKLY_COLUMNS:
+        if column not in NUMBER_COLUMNS:
+            df[column] = df[column].fillna('').astype(str)
+
+    valid = df['answer_id'].notna() & df['question_id'].notna()
+    if (~valid).sum():
+        print(f"{int((~valid).sum())} rows without answer_id or question_id are dropped")
+    missing = valid & df['question_creation_date'].isna()
+    if missing.sum():
+        print(f"{int(missing.sum())} answers whose question was not fetched are dropped")
+        valid &= ~missing
+    return df[valid].drop_duplicates('answer_id').reset_index(drop=True)
+
+
+"""
+Returns the row of stackoverflow_weekly of an accepted answer and its question (None if the question was not fetched)
+"""
+
+def make_record(answer, question):
+    record = {
+        'tags': '',
+        'title': '',
+        'question_body': '',
+        'question_id': answer['question_id'],
+        'answer_creation_date': answer['creation_date'],
+        'question_creation_date':'',
+        'question_score':'',
+        'favorite_count':'',
+        'question_upvote_count':'',
+        'view_count':'',
+        'answer_body': answer['body_markdown'], 
+        'answer_upvote_count':answer['up_vote_count'],
+        'answer_score':answer['score'],
+        'answer_id':answer['answer_id']
+    }
+    # Joining the question of the accepted answer
+    if question is not None:
+        record['question_body'] = question['body_markdown']
+        record['question_upvote_count'] = question['up_vote_count']
+        record['question_score'] = question['score']
+        record['question_creation_date'] = question['creation_date']
+        record['title'] = question['title']
+        record['tags'] = ','.join(question['tags'])
+        record['favorite_count'] = question['favorite_count']
+        record['view_count'] = question['view_count']
+    return record
+
+
+# Table the answers of a run are loaded into before being merged into stackoverflow_weekly
+STAGING_TABLE = 'stackoverflow_weekly_staging'
+
+
+"""
+Inserts validated records into the staging table :
+    - on Snowflake with write_pandas, which PUTs them as a parquet file to the stage of the table and loads it with COPY INTO,
+      so a batch is never bound into one multi-row INSERT statement (that would hit the statement size limit)
+    - on the local stand-in with executemany, LOAD_BATCH_SIZE rows at a time
+"""
+
+def stage_records(conn, cursor, df, local=False):
+    if df.empty:
+        return
+    if local:
+        rows = list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+        for i in range(0, len(rows), LOAD_BATCH_SIZE):
+            cursor.executemany(f"""
+                INSERT INTO {STAGING_TABLE} ({', '.join(WEEKLY_COLUMNS)})
+                VALUES ({', '.join(['%s'] * len(WEEKLY_COLUMNS))})
+            """, rows[i:i + LOAD_BATCH_SIZE])
+        return
+
+    from snowflake.connector.pandas_tools import write_pandas
+    success, _, rows, _ = write_pandas(conn, df[WEEKLY_COLUMNS], STAGING_TABLE, quote_identifiers=False)
+    if not success or rows != len(df):
+        raise RuntimeError(f"{rows} of {len(df)} rows copied into {STAGING_TABLE}")
+
+
+"""
+Returns the statements that apply the staging rows created after the watermark to stackoverflow_weekly :
+    - new answers are inserted, answers whose values changed (scores, views, bodies ...) are updated, the other ones are not touched
+    - a MERGE keyed on answer_id on Snowflake, an UPDATE ... FROM and an INSERT of the missing answers on the local stand-in (no MERGE in SQLite)
+"""
+
+def upsert_sql(watermark, local=False):
+    source = f"(SELECT * FROM {STAGING_TABLE} WHERE answer_creation_date >= {int(watermark)})"
+    columns = ', '.join(WEEKLY_COLUMNS)
+    values = ', '.join('s.' + column for column in WEEKLY_COLUMNS)
+    updates = ', '.join(f"{column} = s.{column}" for column in WEEKLY_COLUMNS if column != 'answer_id')
+    distinct = 'IS NOT' if local else 'IS DISTINCT FROM'
+    changed = ' OR '.join(f"t.{column} {distinct} s.{column}" for column in WEEKLY_COLUMNS if column != 'answer_id')
+
+    if local:
+        return [
+            f"""UPDATE stackoverflow_weekly AS t SET {updates}, loaded_at = CURRENT_TIMESTAMP
+            FROM {source} AS s WHERE t.answer_id = s.answer_id AND ({changed})""",
+            f"""INSERT INTO stackoverflow_weekly ({columns}, loaded_at)
+            SELECT {values}, CURRENT_TIMESTAMP FROM {source} AS s
+            WHERE NOT EXISTS (SELECT 1 FROM stackoverflow_weekly t WHERE t.answer_id = s.answer_id)"""
+        ]
+
+    return [f"""
+        MERGE INTO stackoverflow_weekly t
+        USING {source} s
+        ON t.answer_id = s.answer_id
+        WHEN MATCHED AND ({changed}) THEN UPDATE SET {updates}, loaded_at = CURRENT_TIMESTAMP
+        WHEN NOT MATCHED THEN INSERT ({columns}, loaded_at) VALUES ({values}, CURRENT_TIMESTAMP)
+    """]
+
+
+"""
+Loads the partitions of the fetch tasks into stackoverflow_weekly :
+    - The answers are read, joined with their questions and validated one batch at a time, and inserted into the staging table
+      (see stage_records())
+    - One transaction merges the staging rows into stackoverflow_weekly (see upsert_sql()) and deletes the rows created before
+      the watermark (the start of the rolling window of the last WEEK_DAYS days), so the readers never see a partial week
+      and a rerun only touches the rows that changed
+"""
 
+def load_data_to_snowflake(**kwargs):
+    ti = kwargs['ti']
+    # Getting the uris of the partitions written by the mapped fetch tasks (one per day)
+    answers_files = ti.xcom_pull(task_ids='fetch_stackoverflow_data')
+    answers_files = [answers_files] if isinstance(answers_files, dict) else list(answers_files)
+    partial_days = sorted(answers_file['day'] for answers_file in answers_files if not answers_file.get('complete', True))
+    if partial_days:
+        print(f"The days {partial_days} of the week were only partly fetched (quota limit reached), their missing answers are not loaded")
+    api_key = os.getenv('STACKEXCHANGE_API_KEY')
+    watermark = int(((kwargs.get('data_interval_end') or datetime.now()) - timedelta(days=WEEK_DAYS)).timestamp())
+
+
+    # The questions of all the answers of the week, fetched in batches and joined in memory
+    question_ids = [answer['question_id'] for answers_file in answers_files for batch in read_answers(answers_file['uri'], columns=['question_id']) for answer in batch]
+    questions, questions_complete = fetch_questions(question_ids, api_key)
+    if not questions_complete:
+        print("The questions of the week were only partly fetched (quota limit reached), the answers of the missing questions are not loaded")
+
+    with get_connection_manager().session() as conn:
+        local = isinstance(conn, LocalConnection)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {STAGING_TABLE} AS SELECT {', '.join(WEEKLY_COLUMNS)} FROM stackoverflow_weekly WHERE 1 = 0")
+            cursor.execute(f"DELETE FROM {STAGING_TABLE}")
+
+            # The answers are read, joined and staged one batch at a time
+            # (an answer created on the boundary of two days is in both partitions, it is staged once)
+            staged = 0
+            staged_ids = set()
+            for answers_file in answers_files:
+                for answers in read_answers(answers_file['uri']):
+                    df = validate_records(pd.DataFrame([make_record(answer, questions.get(answer['question_id'])) for answer in answers]))
+                    df = df[~df['answer_id'].isin(staged_ids)]
+                    staged_ids.update(int(answer_id) for answer_id in df['answer_id'])
+                    stage_records(conn, cursor, df, local)
+                    staged += len(df)
+            conn.commit()
+
+            # One transaction : the readers of the table see the previous state until the new week is fully applied
+            cursor.execute("BEGIN")
+            changed = 0
+            for query in upsert_sql(watermark, local):
+                cursor.execute(query)
+                changed += max(cursor.rowcount or 0, 0)
+            cursor.execute("DELETE FROM stackoverflow_weekly WHERE answer_creation_date < %s", (watermark,))
+            expired = max(cursor.rowcount or 0, 0)
+            conn.commit()
+
+            print(f"{staged} of the {sum(answers_file['rows'] for answers_file in answers_files)} answers of {len(answers_files)} partitions staged, "
+                  f"{changed} rows of stackoverflow_weekly inserted or updated, {expired} rows older than the window deleted")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
 
 
 def generate_newsletter():
 
-
-    snowflake_user = os.getenv('SNOWFLAKE_USER')
-    snowflake_password = os.getenv('SNOWFLAKE_PASSWORD')
-    snowflake_acc = os.getenv('SNOWFLAKE_ACCOUNT')
-    snowflake_wh = os.getenv('SNOWFLAKE_WH')
-    snowflake_db = os.getenv('SNOWFLAKE_DB')
-    snowflake_schema = os.getenv('SNOWFLAKE_SCHEMA')
-
-    conn = snowflake.connector.connect(
-        user=snowflake_user,
-        password=snowflake_password,
-        account=snowflake_acc,
-        warehouse=snowflake_wh,
-        database=snowflake_db,
-        schema=snowflake_schema
-    )
-
-    cursor = conn.cursor()
-    cursor.execute("""
+    get_connection_manager().execute("""
         CALL GENERATE_NEWSLETTER();
     """)
-    cursor.close()
-    conn.close()
 
 
 
 
 # Defining the tasks
-fetch_task = PythonOperator(
+# One fetch task per day of the week (the /answers endpoint cannot filter on tags, so the week is sliced by day),
+# at most FETCH_PARALLELISM of them run at once and they share the API rate (see get_limiter())
+fetch_task = PythonOperator.partial(
     task_id='fetch_stackoverflow_data',
     python_callable=fetch_stackoverflow_data,
     dag=dag,
-    provide_context=True
-)
+    max_active_tis_per_dag=FETCH_PARALLELISM
+).expand(op_kwargs=[{'day': day} for day in range(WEEK_DAYS)])
 
 load_task = PythonOperator(
     task_id='load_data_to_snowflake',
@@ -0,0 +1,83 @@
+import sys
+import time
+import random
+from cleaning import CleaningStage, clean_batch
+
+
+"""
+Micro-benchmark of the body-cleaning stage
+
+Usage : python3 bench_cleaning.py [number_of_bodies] [workers]
+
+Process :
+    - Generates synthetic body_markdown values (prose with html entities, inline code, fenced and indented code blocks)
+    - Times the original BeautifulSoup cleaner, the fast cleaner in process and the fast cleaner on a process pool
+    - Checks that the fast cleaner gives the same text as BeautifulSoup (up to whitespace normalization)
+"""
+
+PROSE = [
+    "I&#39;m trying to use a `Map&lt;String, List&lt;Integer&gt;&gt;` but the compiler complains &amp; I don&#39;t know why.",
+    "When I run the query I get &quot;invalid identifier&quot; &gt; even though the column exists.",
+    "Is there a way to do this **without** a loop? I read the docs at [the docs](https://example.com/?a=1&amp;b=2).",
+    "Thanks in advance &mdash; any help is appreciated &hellip;",
+]
+
+CODE = [
+    "    for (int i = 0; i &lt; n; i++) {\n        total += values[i];\n    }",
+    "```python\ndf = df[df[&#39;score&#39;] &gt; 0]\nprint(df.head())\n```",
+    "```sql\nSELECT * FROM t WHERE a &lt;&gt; b AND c = &#39;x&#39;;\n```",
+]
+
+
+def make_body(rng):
+    parts = []
+    for _ in range(rng.randint(2, 8)):
+        parts.append(' '.join(rng.choice(PROSE) for _ in range(rng.randint(1, 4))))
+        if rng.random() < 0.6:
+            parts.append(rng.choice(CODE))
+    return '\r\n\r\n'.join(parts)
+
+
+def normalize(text):
+    return ' '.join(text.split())
+
+
+def timed(label, fn, n):
+    t0 = time.perf_counter()
+    result = fn()
+    duration = time.perf_counter() - t0
+    print(f"{label:<30} {duration:8.3f} s   {n / duration:12.0f} bodies/s")
+    return result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    rng = random.Random(0)
+    bodies = [make_body(rng) for _ in range(n)]
+    print(f"{n} bodies, {sum(map(len, bodies)) / n:.0f} chars on average\n")
+
+    try:
+        reference, _ = timed("bs4 (current)", lambda: clean_batch(bodies, 'bs4'), n)
+    except ImportError:
+        reference = None
+        print("bs4 is not installed, skipping the BeautifulSoup path")
+
+    fast, _ = timed("fast, in process", lambda: clean_batch(bodies, 'fast'), n)
+
+    stage = CleaningStage('fast', workers=workers)
+    timed(f"fast, {workers} processes", lambda: stage.clean_values(bodies), n)
+    stage.close()
+
+    split_stage = CleaningStage('fast', workers=workers, split_code=True)
+    timed(f"fast + code split, {workers} p.", lambda: split_stage.clean_values(bodies), n)
+    split_stage.close()
+
+    if reference is not None:
+        mismatches = sum(normalize(a) != normalize(b) for a, b in zip(reference, fast))
+        print(f"\n{mismatches} bodies differ from the BeautifulSoup output (ignoring whitespace)")
+
+
+if __name__ == '__main__':
+    main()
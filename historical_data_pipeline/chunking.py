@@ -0,0 +1,64 @@
+from embedding_cache import EMBEDDING_MODEL
+
+
+CHUNK_TABLE = 'question_answer_chunks'
+
+# e5-base-v2 truncates its input at 512 tokens : about 1500 characters of StackOverflow text (code is denser than prose),
+# the chunks stay below it with room for the title that is embedded with every chunk
+CHUNK_SIZE = 1200
+CHUNK_OVERLAP = 200
+
+
+"""
+Returns the chunks of the text of a post (question and answer bodies), one row per chunk with its number (f.index) and its text (f.value) :
+the text is split on the markdown structure (headers, paragraphs, code blocks, lines) into windows of at most chunk_size characters
+that overlap by chunk_overlap characters
+"""
+
+def chunks_sql(question_body, answer_body, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    return f"""LATERAL FLATTEN(input => SNOWFLAKE.CORTEX.SPLIT_TEXT_RECURSIVE_CHARACTER(
+        CONCAT(COALESCE({question_body}, ''), '\\n\\n', COALESCE({answer_body}, '')), 'markdown', {int(chunk_size)}, {int(chunk_overlap)})) f"""
+
+
+"""
+Returns the queries that bring the chunks of the final table rows selected by where up to date :
+    - the chunks of the answers whose content hash changed since they were chunked are deleted
+    - the answers without chunks are split and every chunk is embedded (with the title of the question) and inserted
+The chunks of an unchanged answer are kept, so a fill only embeds the chunks of the new and changed answers
+"""
+
+def sync_chunks_sql(where, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, model=EMBEDDING_MODEL):
+    delete_query = f"""
+    DELETE FROM {CHUNK_TABLE} c
+    USING question_answer t
+    WHERE c.answer_id = t.answer_id
+        AND {where}
+        AND c.content_hash IS DISTINCT FROM t.content_hash;
+    """
+
+    insert_query = f"""
+    INSERT INTO {CHUNK_TABLE} (ANSWER_ID, QUESTION_ID, CHUNK_NO, CHUNK_TEXT, CHUNK_EMBEDDING, CONTENT_HASH, UPDATED_AT)
+    SELECT
+        t.answer_id,
+        t.question_id,
+        f.index,
+        f.value::VARCHAR,
+        SNOWFLAKE.CORTEX.EMBED_TEXT_768('{model}', CONCAT(COALESCE(t.title, ''), '\\n', f.value::VARCHAR)),
+        t.content_hash,
+        CURRENT_TIMESTAMP()
+    FROM question_answer t,
+    {chunks_sql('t.question_body', 't.answer_body', chunk_size, chunk_overlap)}
+    WHERE {where}
+        AND NOT EXISTS (SELECT 1 FROM {CHUNK_TABLE} c WHERE c.answer_id = t.answer_id);
+    """
+
+    return delete_query, insert_query
+
+"""
+Returns True if the chunk table exists in the current schema, checked before a fill writes anything so that a missing table
+never leaves the final table merged without its chunks
+"""
+
+def chunk_table_exists(cursor):
+    cursor.execute("""SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = CURRENT_SCHEMA() AND table_name = %s;""", (CHUNK_TABLE.upper(),))
+    return cursor.fetchone()[0] > 0
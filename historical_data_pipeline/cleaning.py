@@ -0,0 +1,136 @@
+import re
+import html
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Fenced code blocks (``` or ~~~) and indented code blocks (4 spaces or a tab after a blank line)
+CODE_BLOCK = re.compile(r'^[ \t]*(```|~~~)[^\n]*\n.*?^[ \t]*\1[ \t]*$'
+                        r'|(?:\A|(?<=\n\n))(?:(?: {4}|\t)[^\n]*(?:\n|\Z))+', re.MULTILINE | re.DOTALL)
+BLANK_LINES = re.compile(r'\n{3,}')
+
+
+"""
+The original cleaner, parses every body as html and keeps its text (slow, kept for comparison and as a fallback)
+"""
+
+def bs4_clean(text):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(text, "html.parser").get_text()
+
+
+"""
+Fast normalizer for the body_markdown field
+
+process :
+    - body_markdown is markdown whose html special characters are encoded as entities (&lt; &gt; &amp; &#39; ...),
+      there are no real html tags to parse so decoding the entities gives the same text as BeautifulSoup.get_text()
+    - The most common entities are decoded with plain str.replace, html.unescape only runs if other entities are left
+    - Normalizes the line endings, removes trailing spaces and collapses runs of blank lines
+"""
+
+def fast_clean(text):
+    # &amp; has to be decoded last, it is left to html.unescape so that "&amp;lt;" gives "&lt;" and not "<"
+    text = text.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"').replace('&#39;', "'")
+    if '&' in text:
+        text = html.unescape(text)
+    text = '\n'.join(line.rstrip(' \t') for line in text.replace('\r\n', '\n').split('\n'))
+    if '\n\n\n' in text:
+        text = BLANK_LINES.sub('\n\n', text)
+    return text.strip('\n')
+
+
+CLEANERS = {
+    'bs4': bs4_clean,
+    'fast': fast_clean
+}
+
+
+"""
+Splits a cleaned body into its prose and its code blocks (fenced and indented), returns (prose, code)
+"""
+
+def split_code_blocks(text):
+    blocks = []
+
+    def keep(match):
+        blocks.append(match.group(0).strip('\n'))
+        return ''
+
+    prose = CODE_BLOCK.sub(keep, text)
+    return BLANK_LINES.sub('\n\n', prose).strip('\n'), '\n\n'.join(blocks)
+
+
+"""
+Cleans a batch of bodies, this is the unit of work sent to the worker processes (it has to be a module level function)
+"""
+
+def clean_batch(values, cleaner='fast', split_code=False):
+    clean = CLEANERS[cleaner]
+    bodies = []
+    codes = []
+    for value in values:
+        text = clean(value) if isinstance(value, str) else ''
+        if split_code:
+            text, code = split_code_blocks(text)
+            codes.append(code)
+        bodies.append(text)
+    return bodies, codes
+
+
+"""
+Pluggable body-cleaning stage used by the PageWriter
+
+Input :
+    - cleaner : name of the cleaner in CLEANERS ('fast' by default, 'bs4' for the original BeautifulSoup behaviour)
+    - workers : number of worker processes, 1 cleans in the calling process
+    - batch_size : number of bodies sent to a worker at once
+    - split_code : if True, the code blocks are removed from the body and stored in an additional 'code' column
+
+Process :
+    - clean_frame() cleans the 'body' column of a dataframe (questions or answers), in batches over a process pool when workers > 1
+    - The pool is created once and shared by every caller (e.g. the crawler threads), close() shuts it down
+"""
+
+class CleaningStage:
+
+    def __init__(self, cleaner='fast', workers=1, batch_size=500, split_code=False):
+        if cleaner not in CLEANERS:
+            raise ValueError("Unknown cleaner : " + str(cleaner) + ", expected one of " + str(list(CLEANERS)))
+        self.cleaner = cleaner
+        self.workers = workers
+        self.batch_size = batch_size
+        self.split_code = split_code
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def clean_values(self, values):
+        if self.workers <= 1:
+            return clean_batch(values, self.cleaner, self.split_code)
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+        batches = [values[i:i + self.batch_size] for i in range(0, len(values), self.batch_size)]
+        futures = [self._pool.submit(clean_batch, batch, self.cleaner, self.split_code) for batch in batches]
+
+        bodies = []
+        codes = []
+        for future in futures:
+            batch_bodies, batch_codes = future.result()
+            bodies += batch_bodies
+            codes += batch_codes
+        return bodies, codes
+
+    def clean_frame(self, df):
+        bodies, codes = self.clean_values(df['body'].to_list())
+        df['body'] = bodies
+        if self.split_code:
+            df['code'] = codes
+        return df
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
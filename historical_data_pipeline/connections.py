@@ -0,0 +1,200 @@
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+"""
+Pool of database connections shared by the stages of the pipeline (stage creation, COPY INTO, final table, airflow tasks)
+
+Input :
+    - connect : function without arguments that opens a new DB-API connection (see snowflake_connection_manager() and local_connection_manager())
+    - max_size : maximum number of connections open at the same time
+    - health_check_interval : a connection idle for longer than this (in seconds) is checked before being reused
+    - health_check_sql : the query used to check a connection
+
+Process :
+    - session() lends a connection for the duration of a with block and takes it back afterwards, the authenticated sessions
+      are kept open between the stages and the runs of the pipeline instead of logging in again every time
+    - Before reusing a connection, the pool drops it if it is closed and runs the health check query if it was idle for a while or
+      if its last use raised an error, a dead connection is replaced by a new one (reconnect)
+    - execute() runs one statement on a pooled connection, and retries it once on a new connection if the first one was broken
+    - close() closes every idle connection, it is called at the end of the pipeline
+"""
+
+class ConnectionManager:
+
+    def __init__(self, connect, max_size=4, health_check_interval=300, health_check_sql='SELECT 1'):
+        self.connect = connect
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.health_check_sql = health_check_sql
+
+        self.connections_opened = 0
+        self._idle = []
+        self._open = 0
+        self._condition = threading.Condition()
+
+    def healthy(self, conn, last_used, suspect):
+        is_closed = getattr(conn, 'is_closed', None)
+        if is_closed is not None and is_closed():
+            return False
+        if not suspect and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.health_check_sql)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception as e:
+            print(f"Connection health check failed, reconnecting: {e}")
+            return False
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def acquire(self):
+        while True:
+            with self._condition:
+                while not self._idle and self._open >= self.max_size:
+                    self._condition.wait()
+                if self._idle:
+                    conn, last_used, suspect = self._idle.pop()
+                else:
+                    self._open += 1
+                    conn = None
+
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self._condition:
+                        self._open -= 1
+                        self._condition.notify()
+                    raise
+                self.connections_opened += 1
+                return conn
+
+            if self.healthy(conn, last_used, suspect):
+                return conn
+            self.discard(conn)
+
+    def release(self, conn, suspect=False):
+        with self._condition:
+            self._idle.append((conn, time.monotonic(), suspect))
+            self._condition.notify()
+
+    @contextmanager
+    def session(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            # The error may come from a dead connection, it is checked before being lent again
+            self.release(conn, suspect=True)
+            raise
+        self.release(conn)
+
+    def execute(self, sql, params=None, fetch=False):
+        for attempt in range(2):
+            conn = self.acquire()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(sql, params) if params is not None else cursor.execute(sql)
+                rows = cursor.fetchall() if fetch else None
+                cursor.close()
+            except Exception:
+                if attempt == 0 and not self.healthy(conn, 0, True):
+                    # The connection was broken, the statement is sent again on a new one
+                    self.discard(conn)
+                    continue
+                self.release(conn, suspect=True)
+                raise
+            self.release(conn)
+            return rows
+
+    def close(self):
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+        for conn, last_used, suspect in idle:
+            self.discard(conn)
+
+
+"""
+Returns a ConnectionManager of Snowflake connections opened with the given credentials
+(client_session_keep_alive keeps the pooled sessions from expiring between two runs of the pipeline)
+"""
+
+def snowflake_connection_manager(snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema, **options):
+    import snowflake.connector
+
+    def connect():
+        return snowflake.connector.connect(
+            user=snowflake_user,
+            password=snowflake_password,
+            account=snowflake_acc,
+            warehouse=snowflake_wh,
+            database=snowflake_db,
+            schema=snowflake_schema,
+            client_session_keep_alive=True
+        )
+
+    return ConnectionManager(connect, **options)
+
+
+"""
+SQLite connection that accepts the %s placeholders of the Snowflake connector, so that the same queries run on both
+"""
+
+class LocalConnection(sqlite3.Connection):
+
+    def cursor(self, *args, **kwargs):
+        return super().cursor(LocalCursor)
+
+
+class LocalCursor(sqlite3.Cursor):
+
+    def execute(self, sql, params=()):
+        return super().execute(sql.replace('%s', '?'), params)
+
+    def executemany(self, sql, seq_of_params):
+        return super().executemany(sql.replace('%s', '?'), seq_of_params)
+
+
+"""
+Returns a ConnectionManager of local SQLite connections, a stand-in for Snowflake to run the pipeline stages offline
+(':memory:' gives every connection its own empty database, use a file path to share the tables between connections)
+"""
+
+def local_connection_manager(database=':memory:', **options):
+
+    def connect():
+        return sqlite3.connect(database, factory=LocalConnection, check_same_thread=False)
+
+    return ConnectionManager(connect, **options)
+
+
+"""
+Lends a connection of manager, or of a one-off Snowflake manager opened with the credentials if no manager is given
+(the behaviour of the pipeline functions called without a shared manager : one connection, closed afterwards)
+"""
+
+@contextmanager
+def snowflake_session(manager, snowflake_user=None, snowflake_password=None, snowflake_acc=None, snowflake_wh=None, snowflake_db=None, snowflake_schema=None):
+    owned = manager is None
+    if owned:
+        manager = snowflake_connection_manager(snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema, max_size=1)
+    try:
+        with manager.session() as conn:
+            yield conn
+    finally:
+        if owned:
+            manager.close()
@@ -0,0 +1,133 @@
+import json
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import fetch_data, load_checkpoint, update_checkpoint
+from rate_limiter import QuotaBudget
+
+
+# Creation date of the first StackOverflow questions, there is nothing to crawl before it
+STACKOVERFLOW_EPOCH = 1217548800
+
+
+"""
+Input :
+    - tag : the tag to split into windows
+    - checkpoint : the content of the checkpoint file
+    - windows_per_tag : number of date windows to crawl in parallel for the tag
+    - now : upper bound (timestamp) of the last window
+
+Process :
+    - Reuses the windows already planned for the tag in the checkpoint (keys "tag|from|to") so that a rerun resumes them
+    - Otherwise splits the dates between the tag checkpoint (or the StackOverflow epoch) and now into equal windows
+    - Returns a list of (checkpoint_key, from_date, to_date)
+"""
+
+def plan_windows(tag, checkpoint, windows_per_tag, now):
+
+    windows = []
+    for key in checkpoint:
+        parts = key.split('|')
+        if len(parts) == 3 and parts[0] == tag:
+            windows.append((key, int(parts[1]), int(parts[2])))
+
+    if windows:
+        return sorted(windows, key=lambda w: w[1])
+
+    start = max(int(checkpoint.get(tag, 0)), STACKOVERFLOW_EPOCH)
+    if start >= now:
+        return []
+
+    step = max((now - start) // windows_per_tag, 1)
+    bounds = [min(start + i * step, now) for i in range(windows_per_tag)] + [now]
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo < hi:
+            windows.append((tag + '|' + str(lo) + '|' + str(hi), lo, hi))
+
+    return windows
+
+
+"""
+Runs fetch_data on a single window with its own http session (sessions are not shared between threads)
+"""
+
+def crawl_window(tag, key, to_date, schedule_path, target_q_dir, target_a_dir, checkpoint_path, api_key, quota_limit, budget, **fetch_options):
+
+    session = requests.Session()
+    try:
+        return fetch_data(session, [tag], schedule_path, target_q_dir, target_a_dir, checkpoint_path, api_key, quota_limit,
+                          to_date=to_date, budget=budget, checkpoint_key=key, **fetch_options)
+    except (Exception, SystemExit) as e:
+        print(f"Window {key} raised an exception: {e}")
+        return None
+    finally:
+        session.close()
+
+
+"""
+Input :
+    - tags : the tags to crawl (each one is crawled separately, like in the single tag mode)
+    - max_workers : number of windows fetched at the same time
+    - windows_per_tag : number of date windows each tag is split into
+    - fetch_options : the optional inputs of fetch_data given to every window, e.g. the RateLimiter shared by all the workers
+      (it keeps them together under the API per-second limit) or the CleaningStage whose process pool cleans the pages of every window
+    - the other inputs are the same as fetch_data
+
+Process :
+    - Plans the date windows of every tag and records them in the checkpoint file
+    - Runs fetch_data on the unfinished windows with a thread pool, all the workers share one QuotaBudget and stop when quota_limit is reached
+    - Marks a tag as done ("1") in the schedule file once all of its windows are complete
+    - Returns False if the quota is consumed, None if every window failed, True otherwise (same meaning as fetch_data)
+"""
+
+def crawl(tags, schedule_path, target_q_dir, target_a_dir, checkpoint_path, api_key, quota_limit=0, max_workers=4, windows_per_tag=4, **fetch_options):
+
+    budget = QuotaBudget(quota_limit)
+    checkpoint = load_checkpoint(checkpoint_path)
+    now = int(time.time())
+
+    jobs = []
+    planned = {}
+    new_windows = {}
+    for tag in tags:
+        planned[tag] = plan_windows(tag, checkpoint, windows_per_tag, now)
+        for key, from_date, to_date in planned[tag]:
+            if key not in checkpoint:
+                new_windows[key] = from_date
+            elif int(checkpoint[key]) >= to_date:
+                continue
+            jobs.append((tag, key, to_date))
+
+    if new_windows:
+        update_checkpoint(checkpoint_path, new_windows)
+
+    print(f"Crawling {len(jobs)} windows of {len(tags)} tags with {max_workers} workers ...")
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(crawl_window, tag, key, to_date, schedule_path, target_q_dir, target_a_dir,
+                        checkpoint_path, api_key, quota_limit, budget, **fetch_options): key
+            for tag, key, to_date in jobs
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"Window {futures[future]} finished with : {result}")
+            results.append(result)
+
+    # A tag is done once all of its windows reached their upper bound
+    checkpoint = load_checkpoint(checkpoint_path)
+    with open(schedule_path, 'r') as f:
+        sch = json.load(f)
+    for tag, windows in planned.items():
+        if all(int(checkpoint.get(key, from_date)) >= to_date for key, from_date, to_date in windows):
+            print("No more data for : " + tag)
+            sch[tag] = "1"
+    with open(schedule_path, 'w') as f:
+        json.dump(sch, f, indent=4)
+
+    if budget.exhausted() or False in results:
+        return False
+    if results and all(result is None for result in results):
+        return None
+    return True
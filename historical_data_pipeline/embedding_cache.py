@@ -0,0 +1,161 @@
+import re
+import json
+import hashlib
+import threading
+
+
+EMBEDDING_MODEL = 'e5-base-v2'
+EMBEDDING_CACHE_TABLE = 'embedding_cache'
+
+# Hash of the embedded text (question and answer bodies with their whitespace normalized), computed in Snowflake
+CONTENT_HASH_SQL = "SHA2(TRIM(REGEXP_REPLACE(CONCAT(COALESCE({q}, ''), ' ', COALESCE({a}, '')), '[[:space:]]+', ' ')), 256)"
+
+# Same characters as the [[:space:]] class of CONTENT_HASH_SQL
+WHITESPACE = re.compile(r'[ \t\n\r\f\v]+')
+
+# Maximum number of hashes in the IN list of a lookup
+LOOKUP_BATCH_SIZE = 1000
+
+
+"""
+Same hash as CONTENT_HASH_SQL, computed in python
+"""
+
+def content_hash(question_body, answer_body):
+    text = WHITESPACE.sub(' ', (question_body or '') + ' ' + (answer_body or '')).strip(' ')
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+"""
+Returns the LEFT JOIN of the cache table on the content hash of a query (cache_alias.embedding is NULL on a miss),
+a hash cached twice (e.g. by two concurrent loads) still gives a single row
+"""
+
+def cache_join_sql(hash_expression, cache_alias='c', model=EMBEDDING_MODEL):
+    return f"""LEFT JOIN (
+        SELECT content_hash, embedding FROM {EMBEDDING_CACHE_TABLE} WHERE model = '{model}'
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY content_hash ORDER BY created_at) = 1
+    ) {cache_alias} ON {cache_alias}.content_hash = {hash_expression}"""
+
+
+"""
+Returns the embedding of a row : the cached one if there is one, otherwise the one computed by Cortex
+"""
+
+def cached_embedding_sql(cached_embedding, question_body, answer_body, model=EMBEDDING_MODEL):
+    return f"""CASE WHEN {cached_embedding} IS NOT NULL THEN {cached_embedding} ELSE SNOWFLAKE.CORTEX.EMBED_TEXT_768('{model}', CONCAT({question_body}, ' ', {answer_body})) END"""
+
+
+"""
+Returns the query that adds the embeddings of the final table rows selected by where to the cache (one row per new content hash)
+"""
+
+def fill_cache_sql(where, model=EMBEDDING_MODEL):
+    return f"""
+    INSERT INTO {EMBEDDING_CACHE_TABLE} (MODEL, CONTENT_HASH, EMBEDDING, CREATED_AT)
+    SELECT '{model}', t.content_hash, t.question_answer_embedding, CURRENT_TIMESTAMP()
+    FROM question_answer t
+    WHERE {where}
+        AND t.content_hash IS NOT NULL
+        AND t.question_answer_embedding IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM {EMBEDDING_CACHE_TABLE} c WHERE c.model = '{model}' AND c.content_hash = t.content_hash)
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY t.content_hash ORDER BY t.answer_id) = 1;
+    """
+
+
+"""
+Returns the query that counts the cache hits and misses of the rows of source (a table or subquery with a cached_embedding column,
+NULL on a miss) that get an embedding : the rows selected by embedded took the cached embedding or called EMBED_TEXT_768,
+one hit or one miss per row
+"""
+
+def cache_stats_sql(source, embedded="1 = 1"):
+    return f"""
+    SELECT
+        COALESCE(SUM(CASE WHEN ({embedded}) AND cached_embedding IS NOT NULL THEN 1 ELSE 0 END), 0),
+        COALESCE(SUM(CASE WHEN ({embedded}) AND cached_embedding IS NULL THEN 1 ELSE 0 END), 0)
+    FROM {source};
+    """
+
+
+"""
+Embedding cache keyed by (model, content hash), stored in the EMBEDDING_CACHE table
+
+Input :
+    - manager : (optional) the ConnectionManager of the cache table (Snowflake, or the local stand-in of local_connection_manager()),
+      only needed by the python lookup layer
+    - model : name of the embedding model, embeddings of different models never mix
+    - local : True if the backend is not Snowflake, the embeddings are then stored as json text instead of VECTOR
+
+Process :
+    - count() counts the hits and misses of a lookup done in SQL with cache_stats_sql() (e.g. a batch of fill_final_table())
+    - lookup() returns the cached embeddings of a list of content hashes and counts the hits and misses
+    - store() adds embeddings to the cache
+    - get_or_compute() embeds only the texts whose hash is not in the cache (with the given compute function) and caches them
+    - stats() returns the totals of the hits and misses
+"""
+
+class EmbeddingCache:
+
+    def __init__(self, manager=None, model=EMBEDDING_MODEL, local=False):
+        self.manager = manager
+        self.model = model
+        self.local = local
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def create_table(self):
+        vector_type = 'TEXT' if self.local else 'VECTOR(FLOAT, 768)'
+        self.manager.execute(f"""CREATE TABLE IF NOT EXISTS {EMBEDDING_CACHE_TABLE} (MODEL VARCHAR(100), CONTENT_HASH VARCHAR(64), EMBEDDING {vector_type}, CREATED_AT TIMESTAMP)""")
+
+    def record(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def count(self, cursor, source, embedded="1 = 1"):
+        cursor.execute(cache_stats_sql(source, embedded))
+        hits, misses = cursor.fetchone()
+        self.record(int(hits), int(misses))
+        return int(hits), int(misses)
+
+    def lookup(self, hashes):
+        hashes = list(dict.fromkeys(hashes))
+        found = {}
+        for i in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+            batch = hashes[i:i + LOOKUP_BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            rows = self.manager.execute(f"""SELECT CONTENT_HASH, EMBEDDING FROM {EMBEDDING_CACHE_TABLE} WHERE MODEL = %s AND CONTENT_HASH IN ({placeholders})""", [self.model] + batch, fetch=True)
+            for hash_value, embedding in rows:
+                found[hash_value] = json.loads(embedding) if isinstance(embedding, str) else list(embedding)
+
+        self.record(len(found), len(hashes) - len(found))
+        return found
+
+    def store(self, embeddings):
+        vector = '%s' if self.local else 'PARSE_JSON(%s)::ARRAY::VECTOR(FLOAT, 768)'
+        timestamp = 'CURRENT_TIMESTAMP' if self.local else 'CURRENT_TIMESTAMP()'
+        with self.manager.session() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                f"""INSERT INTO {EMBEDDING_CACHE_TABLE} (MODEL, CONTENT_HASH, EMBEDDING, CREATED_AT) SELECT %s, %s, {vector}, {timestamp}""",
+                [(self.model, hash_value, json.dumps(list(embedding))) for hash_value, embedding in embeddings.items()]
+            )
+            conn.commit()
+            cursor.close()
+
+    def get_or_compute(self, texts, compute):
+        # texts : {content_hash: text}, compute : function that embeds a list of texts
+        embeddings = self.lookup(texts)
+        missing = [hash_value for hash_value in texts if hash_value not in embeddings]
+        if missing:
+            computed = dict(zip(missing, compute([texts[hash_value] for hash_value in missing])))
+            self.store(computed)
+            embeddings.update(computed)
+        return embeddings
@@ -4,6 +4,11 @@ import time
 import requests
 import json
 from utils import fetch_data, load_into_cloud, copy_into_snowflake_table, fill_final_table
+from crawler import crawl
+from rate_limiter import RateLimiter
+from cleaning import CleaningStage
+from uploader import BlobUploader, storage_connection_string
+from connections import snowflake_connection_manager
 import subprocess
 
 def run_pipeline(quota_limit):
@@ -18,7 +23,27 @@ def run_pipeline(quota_limit):
     target_a_dir = params['target_a_dir']
     checkpoint_path = params['checkpoint_path']
     copy_log = params['copy_log']
+    copy_results = params.get('copy_results', 'copy_results.jsonl') # COPY INTO result of every loaded file
     dbt_project_path = params['dbt_project_path']
+    crawl_mode = params.get('crawl_mode', 'single') # 'single' : one tag at a time, 'concurrent' : all the remaining tags at once
+    max_workers = params.get('max_workers', 4)
+    windows_per_tag = params.get('windows_per_tag', 4)
+    requests_per_second = params.get('requests_per_second', 20)
+    rows_per_file = params.get('rows_per_file', 50000)
+    cleaner = params.get('cleaner', 'fast') # 'fast' : entity/markdown normalizer, 'bs4' : BeautifulSoup (original behaviour)
+    cleaning_workers = params.get('cleaning_workers', 1)
+    split_code_blocks = params.get('split_code_blocks', False)
+    staging_format = params.get('staging_format', 'csv') # 'csv', 'csv.gz' or 'parquet'
+    parquet_compression = params.get('parquet_compression', 'snappy') # 'snappy' or 'zstd'
+    embed_answers = params.get('embed_answers', False) # one /questions call per page with the answers embedded instead of two calls
+    upload_workers = params.get('upload_workers', 8)
+    snowflake_connections = params.get('snowflake_connections', 2)
+    fill_mode = params.get('fill_mode', 'incremental') # 'incremental' : batched MERGE of the new and changed answers, 'full' : original INSERT
+    fill_batch_size = params.get('fill_batch_size', 50000)
+    fill_progress = params.get('fill_progress', 'fill_progress.json')
+    chunk_posts = params.get('chunk_posts', False) # one embedding per overlapping chunk of each post in question_answer_chunks
+    chunk_size = params.get('chunk_size', 1200)
+    chunk_overlap = params.get('chunk_overlap', 200)
 
     
     snowflake_user = os.getenv('SNOWFLAKE_USER')
@@ -33,6 +58,23 @@ def run_pipeline(quota_limit):
     snowflake_password = os.getenv('SNOWFLAKE_PASSWORD')
     account_key = os.getenv('AZURE_ACC_KEY')
 
+    # Every StackExchange call of the run goes through this limiter (token bucket + API backoff + retries)
+    limiter = RateLimiter(rate=requests_per_second)
+    cleaning_stage = CleaningStage(cleaner, cleaning_workers, split_code=split_code_blocks)
+    fetch_options = {
+        'limiter': limiter,
+        'rows_per_file': rows_per_file,
+        'cleaning_stage': cleaning_stage,
+        'embed_answers': embed_answers,
+        'staging_format': staging_format,
+        'compression': parquet_compression
+    }
+
+    # Snowflake sessions shared by the COPY INTO and the final table of every run (one login instead of one per stage)
+    manager = snowflake_connection_manager(snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema, max_size=snowflake_connections)
+
+    # Shared by every run so that each container is only listed once
+    uploader = BlobUploader(storage_connection_string(account_name, account_key), max_workers=upload_workers)
 
     
     while True:
@@ -44,26 +86,26 @@ def run_pipeline(quota_limit):
             with open(schedule_path, 'r+') as f:
                 sch = json.load(f)
 
-            target_tag = None
-            for key, val in sch.items():
-                if val == '0':
-                    target_tag = key
-                    break
+            target_tags = [key for key, val in sch.items() if val == '0']
 
             fetch_t0 = time.time()
-            return_val = fetch_data(session, [target_tag], schedule_path, target_q_dir, target_a_dir, checkpoint_path, api_key, quota_limit)
+            if crawl_mode == 'concurrent':
+                return_val = crawl(target_tags, schedule_path, target_q_dir, target_a_dir, checkpoint_path, api_key, quota_limit, max_workers, windows_per_tag, **fetch_options)
+            else:
+                target_tag = target_tags[0] if target_tags else None
+                return_val = fetch_data(session, [target_tag], schedule_path, target_q_dir, target_a_dir, checkpoint_path, api_key, quota_limit, **fetch_options)
             fetch_tf = time.time()
 
-            print("Fetching duration : " + str(round(fetch_tf-fetch_t0, 2)))
+            print("Fetching duration : " + str(round(fetch_tf-fetch_t0, 2)) + ", quota remaining : " + str(limiter.quota_remaining))
 
             load_t0 = time.time()
-            load_into_cloud(target_q_dir, target_a_dir, copy_log, account_name, account_key)
+            load_into_cloud(target_q_dir, target_a_dir, copy_log, account_name, account_key, uploader=uploader)
             load_tf = time.time()
 
             print("Loading duration : " + str(round(load_tf - load_t0, 2)))
 
             copy_t0 = time.time()
-            copy_into_snowflake_table(copy_log, file_format_name, snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema)
+            copy_into_snowflake_table(copy_log, file_format_name, snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema, manager=manager, copy_results=copy_results)
             copy_tf = time.time()
 
             print("Copying duration : " + str(round(copy_tf - copy_t0, 2)))
@@ -91,12 +133,14 @@ def run_pipeline(quota_limit):
             except subprocess.CalledProcessError as e:
                 print("Error running DBT model:", e.stderr)
 
-            fill_final_table(snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema)
+            fill_final_table(snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema, manager=manager, mode=fill_mode, batch_size=fill_batch_size, progress_path=fill_progress, chunks=chunk_posts, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
         elif behaviour == "rerun":
             print("Waiting for 60 seconds before rerunning...")
             time.sleep(60)
         elif behaviour == "stop":
             print("Stopping the process.")
+            cleaning_stage.close()
+            manager.close()
             break
 
 
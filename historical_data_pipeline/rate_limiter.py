@@ -0,0 +1,159 @@
+import re
+import time
+import random
+import threading
+import requests
+
+
+# The StackExchange API drops the requests of an IP that makes more than 30 requests per second
+API_MAX_REQUESTS_PER_SECOND = 30
+
+# Errors worth retrying, any other API error (bad parameter, invalid key ...) would fail again
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRYABLE_ERROR_NAMES = ('throttle_violation', 'temporarily_unavailable', 'internal_error')
+
+
+"""
+Quota credit of a fetch, shared by all the crawler workers in concurrent mode
+
+process :
+    - Every worker reports the quota_remaining field of each API response with update()
+    - The lowest reported value is kept (responses of concurrent workers can arrive out of order)
+    - exhausted() tells the workers to stop once the remaining quota reaches quota_limit
+"""
+
+class QuotaBudget:
+
+    def __init__(self, quota_limit, quota_remaining=None):
+        self.quota_limit = quota_limit
+        self.quota_remaining = quota_remaining
+        self._lock = threading.Lock()
+
+    def update(self, quota_remaining):
+        with self._lock:
+            if self.quota_remaining is None or quota_remaining < self.quota_remaining:
+                self.quota_remaining = quota_remaining
+
+    def exhausted(self):
+        with self._lock:
+            return self.quota_remaining is not None and self.quota_remaining <= self.quota_limit
+
+
+"""
+Rate limiting layer that all the StackExchange API calls go through
+
+Input :
+    - rate : number of requests allowed per second (the token bucket refill rate), it should stay under API_MAX_REQUESTS_PER_SECOND
+    - capacity : size of the token bucket, the number of requests that can be sent in a burst
+    - max_retries : number of retries of a failed call before giving up
+    - base_delay / max_delay : bounds (in seconds) of the jittered exponential delay between retries
+    - max_wait : a throttle violation asking to wait longer than this (quota exhausted for the day) is not retried
+    - timeout : timeout (in seconds) of a single http request
+
+Process :
+    - acquire() blocks until a token is available and until the last backoff asked by the API has expired
+    - get() sends a request, honours the 'backoff' field of the response, keeps quota_remaining up to date and retries
+      timeouts, connection errors, throttle violations and server errors with a jittered exponential delay
+    - The limiter is thread safe, so concurrent crawler workers can share it and stay under the per-second limit together
+"""
+
+class RateLimiter:
+
+    def __init__(self, rate=20, capacity=API_MAX_REQUESTS_PER_SECOND, max_retries=5, base_delay=1.0, max_delay=60.0, max_wait=300, timeout=30):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+        self.quota_remaining = None
+        self.quota_max = None
+
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._backoff_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+
+                if now < self._backoff_until:
+                    wait = self._backoff_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def backoff(self, seconds):
+        # The API asks not to call the same method again for this amount of seconds, we pause every call to stay on the safe side
+        with self._lock:
+            self._backoff_until = max(self._backoff_until, time.monotonic() + seconds)
+
+    def retry_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def get(self, session, url, params):
+
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+
+            try:
+                response = session.get(url, params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException as err:
+                # No response at all (timeout, connection reset ...)
+                print("Request error:", err)
+                time.sleep(self.retry_delay(attempt))
+                continue
+
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = None
+
+            if isinstance(payload, dict):
+                if 'backoff' in payload:
+                    print(f"The API asked for a backoff of {payload['backoff']} seconds")
+                    self.backoff(payload['backoff'])
+                if 'quota_remaining' in payload:
+                    self.quota_remaining = payload['quota_remaining']
+                    self.quota_max = payload.get('quota_max', self.quota_max)
+
+            if response.ok and isinstance(payload, dict) and 'error_id' not in payload:
+                return payload
+
+            error_name = payload.get('error_name') if isinstance(payload, dict) else None
+            error_message = payload.get('error_message', '') if isinstance(payload, dict) else response.text[:200]
+            print(f"API error ({response.status_code}, {error_name}): {error_message}")
+
+            if error_name == 'throttle_violation':
+                # e.g. "too many requests from this IP, more requests available in 80 seconds"
+                match = re.search(r'(\d+) seconds', error_message)
+                if match:
+                    wait = int(match.group(1))
+                    if wait > self.max_wait:
+                        print("The daily quota is exhausted, giving up")
+                        return None
+                    self.backoff(wait)
+                    continue
+
+            if error_name in RETRYABLE_ERROR_NAMES or response.status_code in RETRYABLE_STATUS_CODES or payload is None:
+                time.sleep(self.retry_delay(attempt))
+                continue
+
+            return None
+
+        print(f"Giving up after {self.max_retries + 1} attempts")
+        return None
+
+
+# Limiter shared by all the calls that do not receive their own
+stackexchange_limiter = RateLimiter()
@@ -0,0 +1,88 @@
+import pytest
+from connections import local_connection_manager
+from embedding_cache import EmbeddingCache, content_hash
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = local_connection_manager(str(tmp_path / 'cache.db'))
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def cache(manager):
+    cache = EmbeddingCache(manager, local=True)
+    cache.create_table()
+    return cache
+
+
+def test_content_hash_normalizes_whitespace():
+    assert content_hash("How to  merge\n", "Use\tpd.merge ") == content_hash("How to merge", "Use pd.merge")
+    assert content_hash("How to merge", "Use pd.merge") != content_hash("How to merge", "Use pd.concat")
+    assert content_hash(None, None) == content_hash('', '')
+
+
+def test_store_then_lookup(cache):
+    cache.store({'a': [0.1, 0.2], 'b': [0.3, 0.4]})
+
+    found = cache.lookup(['a', 'b', 'c', 'a'])
+
+    assert found == {'a': [0.1, 0.2], 'b': [0.3, 0.4]}
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3}
+
+
+def test_models_do_not_mix(manager, cache):
+    cache.store({'a': [1.0]})
+    other = EmbeddingCache(manager, model='other-model', local=True)
+
+    assert other.lookup(['a']) == {}
+
+
+def test_get_or_compute_only_embeds_the_misses(cache):
+    cache.store({'a': [1.0]})
+    computed = []
+
+    def compute(texts):
+        computed.extend(texts)
+        return [[float(len(text))] for text in texts]
+
+    first = cache.get_or_compute({'a': 'text a', 'b': 'text bb'}, compute)
+    second = cache.get_or_compute({'a': 'text a', 'b': 'text bb'}, compute)
+
+    assert first == second == {'a': [1.0], 'b': [7.0]}
+    assert computed == ['text bb']
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['misses'] == 1
+
+
+def test_count_one_hit_or_miss_per_embedded_row(manager):
+    cache = EmbeddingCache(manager, local=True)
+    manager.execute("CREATE TABLE fill_batch (answer_id INTEGER, content_hash TEXT, cached_embedding TEXT, action TEXT)")
+    manager.execute("""INSERT INTO fill_batch VALUES
+        (1, 'h1', '[1.0]', 'insert'),
+        (2, 'h2', NULL, 'insert'),
+        (3, 'h2', NULL, 'embed'),
+        (4, 'h3', NULL, 'hash'),
+        (5, 'h4', '[2.0]', NULL)""")
+
+    with manager.session() as conn:
+        cursor = conn.cursor()
+        hits, misses = cache.count(cursor, 'fill_batch', "action IN ('insert', 'embed')")
+        cursor.close()
+
+    # Two rows with the same new hash are both embedded, the hash-only and unchanged rows embed nothing
+    assert (hits, misses) == (1, 2)
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'hit_rate': 1 / 3}
+
+
+def test_empty_source_counts_nothing(manager):
+    cache = EmbeddingCache(manager, local=True)
+    manager.execute("CREATE TABLE fill_batch (cached_embedding TEXT, action TEXT)")
+
+    with manager.session() as conn:
+        cursor = conn.cursor()
+        assert cache.count(cursor, 'fill_batch') == (0, 0)
+        cursor.close()
+
+    assert cache.stats()['hit_rate'] == 0.0
@@ -0,0 +1,83 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob import BlobServiceClient
+
+
+# Overrides the storage account of the pipeline, e.g. "UseDevelopmentStorage=true" for a local Azurite emulator
+CONNECTION_STRING_VARIABLE = 'AZURE_STORAGE_CONNECTION_STRING'
+
+
+"""
+Returns the connection string of the storage account : the AZURE_STORAGE_CONNECTION_STRING environment variable if it is set,
+otherwise the connection string of the Azure account built from its name and key
+"""
+
+def storage_connection_string(account_name, account_key):
+    connection_string = os.getenv(CONNECTION_STRING_VARIABLE)
+    if connection_string:
+        return connection_string
+    return 'DefaultEndpointsProtocol=https;AccountName=' + str(account_name) + ';AccountKey=' + str(account_key) + ';EndpointSuffix=core.windows.net'
+
+
+"""
+Parallel uploader of the staging files, used by load_into_cloud()
+
+Input :
+    - connection_string : connection string of the storage account (see storage_connection_string())
+    - max_workers : number of files uploaded at the same time
+    - chunk_size : size (in bytes) of the blocks read from the file handles and sent to the container
+    - max_concurrency : number of blocks of a single file uploaded at the same time
+
+Process :
+    - index() lists a container once and keeps the names of its blobs in a set, the uploads of the run are added to it,
+      so checking if a file is already loaded no longer lists the container
+    - upload() streams every file from its handle in blocks of chunk_size (the file is never read in memory at once)
+      on a thread pool, and returns the result of each upload (the etag of the blob, or the error)
+    - A file counts as loaded only if its upload returned an etag, there is no need to list the containers again to verify
+"""
+
+class BlobUploader:
+
+    def __init__(self, connection_string, max_workers=8, chunk_size=4 * 1024 * 1024, max_concurrency=2):
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency
+        self.blob_service_client = BlobServiceClient.from_connection_string(
+            connection_string,
+            max_single_put_size=chunk_size,
+            max_block_size=chunk_size
+        )
+
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def index(self, container_name):
+        with self._lock:
+            if container_name not in self._indexes:
+                container_client = self.blob_service_client.get_container_client(container_name)
+                self._indexes[container_name] = {blob.name for blob in container_client.list_blobs()}
+            return self._indexes[container_name]
+
+    def exists(self, container_name, blob_name):
+        return blob_name in self.index(container_name)
+
+    def upload_file(self, container_name, file_path, blob_name=None, overwrite=False):
+        blob_name = blob_name or os.path.basename(file_path)
+        blob_client = self.blob_service_client.get_blob_client(container_name, blob_name)
+
+        try:
+            with open(file_path, "rb") as local_file:
+                result = blob_client.upload_blob(local_file, length=os.path.getsize(file_path), overwrite=overwrite, max_concurrency=self.max_concurrency)
+        except Exception as e:
+            return {'file_path': file_path, 'container': container_name, 'blob_name': blob_name, 'etag': None, 'error': str(e)}
+
+        with self._lock:
+            if container_name in self._indexes:
+                self._indexes[container_name].add(blob_name)
+        return {'file_path': file_path, 'container': container_name, 'blob_name': blob_name, 'etag': result.get('etag'), 'error': None}
+
+    def upload(self, files, overwrite=False):
+        # files : {file_path: container_name}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.upload_file, container_name, file_path, None, overwrite) for file_path, container_name in files.items()]
+            return [future.result() for future in futures]
@@ -1,12 +1,115 @@
-import requests
-import snowflake.connector
 import pandas as pd
 import json
 import os
 import shutil
-from azure.storage.blob import BlobServiceClient
-import time
-from bs4 import BeautifulSoup
+import threading
+import queue
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import QuotaBudget, stackexchange_limiter
+from writers import PageWriter, STAGING_FORMATS, staging_format_of
+from uploader import BlobUploader, storage_connection_string
+from connections import snowflake_session, snowflake_connection_manager
+from embedding_cache import EmbeddingCache, CONTENT_HASH_SQL, cache_join_sql, cached_embedding_sql, fill_cache_sql
+from chunking import CHUNK_TABLE, CHUNK_SIZE, CHUNK_OVERLAP, sync_chunks_sql, chunk_table_exists
+
+
+# Several crawler workers may read and write the checkpoint file at the same time
+_checkpoint_lock = threading.Lock()
+
+
+"""
+Reads the checkpoint file (json) and returns its content as a dict, an empty or missing file gives an empty dict
+"""
+
+def load_checkpoint(checkpoint_path):
+    with _checkpoint_lock:
+        try:
+            with open(checkpoint_path, 'r') as f:
+                if(os.path.getsize(checkpoint_path) == 0):
+                    return {}
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+
+"""
+Sets the given keys of the checkpoint file to the given values (as strings) and leaves the other keys untouched
+The whole read-modify-write is done under a lock so concurrent workers do not overwrite each other's progress
+"""
+
+def update_checkpoint(checkpoint_path, values):
+    with _checkpoint_lock:
+        try:
+            with open(checkpoint_path, 'r') as f:
+                data = {} if os.path.getsize(checkpoint_path) == 0 else json.load(f)
+        except FileNotFoundError:
+            data = {}
+
+        for key, val in values.items():
+            data[key] = str(val)
+
+        with open(checkpoint_path, 'w') as f:
+            json.dump(data, f)
+
+
+# Fields of the questions kept by fetch_data (the 'answers' field is only requested in embedded answers mode)
+QUESTION_FIELDS = ['tags', 'accepted_answer_id', 'answer_count', 'score', 'creation_date', 'question_id', 'title', 'body_markdown']
+QUESTIONS_FILTER = '!)riR7ZJuB__VlNdi-mPJ'
+
+# Filters created with /filters/create, cached for the whole process
+_filters = {}
+
+
+"""
+Input :
+    - session : the http session
+    - limiter : (optional) the RateLimiter the call goes through
+
+process :
+    - Creates (once per process) a filter based on the questions filter that also embeds the answers of each question
+      with their is_accepted and body_markdown fields
+    - With this filter, a single /questions call returns the questions and their accepted answers
+    - Returns the filter string, or None if it could not be created
+"""
+
+def get_embedded_answers_filter(session, limiter=None):
+
+    if 'embedded_answers' in _filters:
+        return _filters['embedded_answers']
+
+    params = {
+        'include':'question.answers;answer.answer_id;answer.question_id;answer.is_accepted;answer.body_markdown',
+        'base':QUESTIONS_FILTER,
+        'unsafe':'false'
+    }
+
+    payload = (limiter or stackexchange_limiter).get(session, 'https://api.stackexchange.com/2.3/filters/create', params)
+    if payload is None or len(payload.get('items', [])) == 0:
+        print("Could not create the embedded answers filter")
+        return None
+
+    _filters['embedded_answers'] = payload['items'][0]['filter']
+    return _filters['embedded_answers']
+
+
+"""
+Picks the accepted answer of each question out of its embedded 'answers' field (embedded answers mode of fetch_data)
+Returns a dataframe with the columns ['answer_id', 'question_id', 'body_markdown']
+"""
+
+def accepted_answers(df):
+
+    records = []
+    for accepted_answer_id, answers in zip(df['accepted_answer_id'], df['answers']):
+        if not isinstance(answers, list):
+            continue
+        for answer in answers:
+            if answer.get('is_accepted') or answer.get('answer_id') == accepted_answer_id:
+                records.append(answer)
+                break
+
+    return pd.DataFrame(records, columns=['answer_id', 'question_id', 'body_markdown'])
 
 
 """
@@ -16,14 +119,15 @@ for question retrieval
 Input : 
     - id_list : a list of answer ids (ideally the accepted_answer_id from the question recording), (should not exceed 100 elements)
     - api_key : the stackexchange api personal key
+    - limiter : (optional) the RateLimiter the call goes through, the shared stackexchange_limiter by default
 
 process :
     - Uses a specific stackexchange api endpoint for answer retrieval
     - Uses the id_list as a parameter to target the wanted answers
-    - Returns the response if the call is successful, returns None object otherwise
+    - Returns the response json if the call is successful, returns None object otherwise
 """
 
-def get_answers_by_id(session, id_list, api_key):
+def get_answers_by_id(session, id_list, api_key, limiter=None):
     
     params = {
         'key':api_key,
@@ -35,15 +139,70 @@ def get_answers_by_id(session, id_list, api_key):
     url=f"https://api.stackexchange.com/2.3/answers/"
 
     url = url + ';'.join(map(lambda x: str(int(x)), id_list))
+
+    payload = (limiter or stackexchange_limiter).get(session, url, params)
+    if payload is None:
+        print("Encountered an error while fetching answers")
+
+    return payload
+
+
+"""
+Producer side of fetch_data(), runs in its own thread with its own http session
+
+Input :
+    - url / params : the questions endpoint and its parameters
+    - columns : the fields of the questions to keep
+    - from_date : creation date of the first page to request
+    - pages : the bounded queue the pages are put in
+    - stop : event set by the consumer when it does not need more pages
+
+process :
+    - Requests the pages of questions one after the other, the fromdate of the next page only depends on the questions
+      of the current one so it does not have to wait for their answers
+    - Puts ('page', (df, from_date, next_from_date, has_more)) for each page, then ('end', has_more) or ('error', None)
+    - The queue is bounded, so the producer is at most a few pages ahead of the consumer
+"""
+
+def produce_question_pages(session, url, params, columns, from_date, limiter, budget, pages, stop):
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    params = dict(params)
+    has_more = True
     try:
-        response = session.get(url, params=params)
-        response.raise_for_status()
+        while has_more and not budget.exhausted() and not stop.is_set():
+            params['fromdate'] = from_date
 
-    except requests.exceptions.RequestException as err:
-        print("Encountered an error while fetching answers:",err)
-        return None
+            payload = limiter.get(session, url, params)
 
-    return response
+            if payload is None or 'has_more' not in payload: # In case the request failed or the response json is an error message (do not append it to data)
+                print("Error while retrieving questions : ", payload)
+                put(('error', None))
+                return
+
+            budget.update(payload['quota_remaining'])
+            has_more = payload['has_more']
+            questions_dict = payload['items']
+            if len(questions_dict) == 0:
+                break
+            df = pd.DataFrame(questions_dict, columns=columns)
+            next_from_date = int(df['creation_date'].max()) + 1
+
+            put(('page', (df, from_date, next_from_date, has_more)))
+            from_date = next_from_date
+
+        put(('end', has_more))
+
+    except Exception as e:
+        print("Error in the questions producer : ", e)
+        put(('error', None))
 
 
 """
@@ -52,41 +211,47 @@ Input :
     - checkpoint_path : the path to the the checkpoint file (json) --if it doesn't exist, the function will create it--
     - quota_limit : the threshold of quota credit under which the function shall stop
     - api_key : the stackexchange api personal key
+    - to_date : (optional) upper bound of the creation date window to retrieve, used by the concurrent crawler
+    - budget : (optional) a QuotaBudget shared between crawler workers, the function stops as soon as it is exhausted
+    - checkpoint_key : (optional) key of the checkpoint entry to use instead of the tag (one key per crawler window)
+    - limiter : (optional) the RateLimiter all the calls go through, the shared stackexchange_limiter by default
+    - rows_per_file : (optional) number of questions per output file before a new file is started
+    - staging_format : (optional) format of the output files, 'csv' (default), 'csv.gz' or 'parquet'
+    - compression : (optional) compression codec of the parquet files, 'snappy' (default) or 'zstd'
+    - cleaning_stage : (optional) the CleaningStage applied to the bodies before they are written
+    - prefetch_pages : (optional) number of pages of questions that can be retrieved ahead of their answers
+    - embed_answers : (optional) if True, the answers are embedded in the /questions response (get_embedded_answers_filter) and the
+      accepted ones are picked locally, a page then costs one API call instead of two
 
 Process :
     - Uses the stackexchange API to retrieve questions and their answers (that meet specific requirements) historically from oldest to newest.
-    - In the while loop, each iteration retrieves 100 questions as well as their accepted answers
-    - Uses a checkpoint file to keep track of the date of the latest retrieved question in order to use it as a starting point in the next call
-    - Saves the questions in a csv file with the following columns :
+    - Pages of 100 questions are retrieved by a producer thread (produce_question_pages) while the loop retrieves the accepted answers
+      of the previous page, so the two requests of a page overlap instead of following each other
+    - Each page is appended to the output files (PageWriter) as soon as its answers are retrieved, only one page is kept in memory
+    - Uses a checkpoint file to keep track of the date of the latest written question in order to use it as a starting point in the next call,
+      the checkpoint moves forward after every page that is readable on disk (every page in csv, every closed file in parquet) so a crash
+      never loses the pages written before it
+    - Saves the questions in csv (or gzip csv, or parquet) files with the following columns :
             ['tags', 'accepted_answer_id', 'answer_count', 'score', 'creation_date', 'question_id', 'title', 'body']
-    - Saves the answers in a csv file with the following columns :
+    - Saves the answers in csv (or gzip csv, or parquet) files with the following columns :
             ['answer_id', 'question_id', 'body']
 """
 
-def fetch_data(session, tags, schedule_path, target_q_dir, target_a_dir, checkpoint_path, api_key, quota_limit=0):
+def fetch_data(session, tags, schedule_path, target_q_dir, target_a_dir, checkpoint_path, api_key, quota_limit=0, to_date=None, budget=None, checkpoint_key=None, limiter=None, rows_per_file=50000, cleaning_stage=None, prefetch_pages=1, embed_answers=False, staging_format='csv', compression='snappy'):
 
     
     url='https://api.stackexchange.com/2.3/questions'
     tag_value = ";".join(tags)
-    # Check if the checkpoint file exists and load the latest date, otherwise create the checkpoint file
-    try:
-        with open(checkpoint_path, 'r+') as f:
-            if(os.path.getsize(checkpoint_path) == 0):
-                data = {}
-            else:
-                data = json.load(f)
-    except FileNotFoundError:
-        with open(checkpoint_path, 'w') as fp:
-            pass
-        data = {}
-    
-    if tag_value in data:
-        from_date = int(data[tag_value])
+    # Load the latest date from the checkpoint file, a crawler window uses its own key instead of the tag
+    if checkpoint_key is None:
+        checkpoint_key = tag_value
+    data = load_checkpoint(checkpoint_path)
+
+    if checkpoint_key in data:
+        from_date = int(data[checkpoint_key])
     else:
         from_date = 0
-        with open(checkpoint_path, 'w') as f1:
-            data[tag_value] = "0"
-            json.dump(data , f1)
+        update_checkpoint(checkpoint_path, {checkpoint_key: from_date})
 
     # api request parameters
     params = {
@@ -97,166 +262,104 @@ def fetch_data(session, tags, schedule_path, target_q_dir, target_a_dir, checkpo
         'site':'stackoverflow', 
         'tagged':tag_value, # Select only questions that are tagged with this specific set of tags
         'fromdate':from_date, # Select only questions that were created after this data (date in timestamp)
-        'filter':'!)riR7ZJuB__VlNdi-mPJ' # This filter specifies the attributes that we want, I made it using the API's documentation ( https://api.stackexchange.com/docs/questions#&filter=!)riR7ZJuB__VlNdi.(a2&site=stackoverflow&run=true )
+        'filter':QUESTIONS_FILTER # This filter specifies the attributes that we want, I made it using the API's documentation ( https://api.stackexchange.com/docs/questions#&filter=!)riR7ZJuB__VlNdi.(a2&site=stackoverflow&run=true )
     }
+    if to_date is not None:
+        params['todate'] = to_date # Select only questions that were created before the end of the crawler window
 
-    num_time_outs = 0 # Count the number of consecutive time outs before terminating the process
-    """
-        The first request that initializes the initial batch of questions as a pandas dataframe
-        In case there is a timeout error, we keep retrying until we reach 1000 consecutive timeouts then we terminate the process
-    """   
-    while(1):
-        time.sleep(2)
-        try:
-            response = session.get(url, params=params)
-            response.raise_for_status()
-            break
-
-        except requests.exceptions.Timeout as errt:
-            print ("Timeout Error:",errt)
-            if(num_time_outs<10):
-                num_time_outs += 1
-                continue
-            else:
-                print("10 consecutive time outs (Initial Batch), terminating process ..")
-                raise SystemExit(errt)
-
-        except requests.exceptions.RequestException as err:
-            print("Initial batch retrieval error :")
-            if(response.json()['error_name']=='throttle_violation'):
-                print("Encountered a throttle violation error, pausing for 30 seconds ...")
-                time.sleep(30)
-            print(response.json())
-            return None
-
-    quota_remaining = response.json()['quota_remaining']
-    questions_dict = response.json()['items']
-    df0 = pd.DataFrame(questions_dict, columns=['tags', 'accepted_answer_id', 'answer_count', 'score', 'creation_date', 'question_id', 'title', 'body_markdown'])
-    from_date = df0['creation_date'].max() + 1
-    df0 = df0[df0['accepted_answer_id'].notna()] # We keep only questions that have accepted answers
-    """
-    We use the get_answers_by_id function to retrieve answers for the questions we just retrieved above
-    In case the call fails, we keep trying a 100 times at most before abandoning the process
-    If the call for answers fails, we terminate the process, no need to continue if the initial batch of answers can not be retrieved
-    """
-    answer_retries = 10
-
-    while(answer_retries > 0):
-        # time.sleep(2)
-        answer_response = get_answers_by_id(session, df0['accepted_answer_id'].to_list())
-        if(answer_response is not None):
-            break
-        answer_retries -= 1
+    if limiter is None:
+        limiter = stackexchange_limiter
 
-    if(answer_response is None):
-        print("Failed to load answers of the initial batch")
-        return None
-        
-    quota_remaining = answer_response.json()['quota_remaining']
-    if(quota_remaining < 2):
-        print("No more quota !")
-        return False
-    answers_dict = answer_response.json()['items']
-    df0_a = pd.DataFrame(answers_dict, columns=['last_activity_date', 'answer_id', 'question_id', 'body_markdown'])
-    df0_a.drop('last_activity_date', axis=1, inplace=True)
+    if budget is None:
+        budget = QuotaBudget(quota_limit)
 
-    num_time_outs = 0
+    columns = QUESTION_FIELDS
+    if embed_answers:
+        embedded_filter = get_embedded_answers_filter(session, limiter)
+        if embedded_filter is None:
+            return None
+        params['filter'] = embedded_filter
+        columns = QUESTION_FIELDS + ['answers']
+
+    writer = PageWriter(target_q_dir, target_a_dir, tag_value, rows_per_file, cleaning_stage, staging_format, compression)
+    checkpoint_date = from_date
+    has_more = True
+    failed = False
+
+    pages = queue.Queue(maxsize=prefetch_pages)
+    stop = threading.Event()
+    producer_session = requests.Session()
+    producer = threading.Thread(target=produce_question_pages, args=(producer_session, url, params, columns, from_date, limiter, budget, pages, stop), daemon=True)
+    producer.start()
     """ 
-    - Keep making requests until the quota_limit parameter is reached
-    - Same error handling for timeout exception as before
-    - In case there is an error :
-        * if the number of questions retrieved that far is < 1000, terminate the process without saving
-        * if it exceeds 1000, save the questions and update the checkpoint
+    - Keep making requests until the quota_limit parameter is reached or there is no more data
+    - Timeouts, throttle violations and server errors are retried by the rate limiter
+    - In case there is an error anyway, stop : the pages written so far are kept and the next run resumes from the checkpoint
     """
-    while (quota_remaining > quota_limit):
-        time.sleep(9)
-        params['fromdate'] = from_date
-
-        try:
-            response = session.get(url, params=params)
-            response.raise_for_status()
+    try:
+        while True:
+            kind, value = pages.get()
 
-        except requests.exceptions.Timeout as errt:
-            print ("Timeout Error:",errt)
-            if(num_time_outs<1):
-                num_time_outs += 1
-                continue
-            else:
-                print("10 Consecutive Timeout errors")
-                if(len(df0) > 1000):
-                    print("Saving data ...")
-                    break
-                print("No data will be saved, terminating the process..")
-                return None
-        except requests.exceptions.RequestException as err:
-            print("Error while retrieving questions :")
-            if(response.json()['error_name']=='throttle_violation'):
-                print("Encountered a throttle violation error, pausing for 30 seconds ...")
-                time.sleep(30)
-            print(response.json())
-            if(len(df0) > 1000):
-                print("Error : ", err)
-                print("Saving data ...")
+            if kind == 'error':
+                failed = True
+                break
+            if kind == 'end':
+                has_more = value
                 break
-            print("No data will be saved, terminating the process..")
-            print("Encountered an error while retrieving questions in the loop :", err)
-            return None
 
+            df, page_from_date, next_from_date, has_more = value
 
-        if 'has_more' not in response.json(): # In case the response json is an error message (do not append it to data)
-            print("Unexpected Response : ", response.json())
-            if(len(df0) > 1000):
-                print("Saving data ...")
-                break
-            print("No data will be saved, terminating the process..")
-            raise SystemExit()
-
-        if 'quota_remaining' in response.json():
-            quota_remaining = response.json()['quota_remaining']
-            questions_dict = response.json()['items']
-            df = pd.DataFrame(questions_dict, columns=['tags', 'accepted_answer_id', 'answer_count', 'score', 'creation_date', 'question_id', 'title', 'body_markdown'])
-
-        # Update from_date ONLY if the answers were successfully retrieved 
-
-        tmp_from_date = df['creation_date'].max() + 1
-
-        df = df[df['accepted_answer_id'].notna()]
-
-        """
-        We use the get_answers_by_id function to retrieve answers for the questions we just retrieved above
-        In case the call fails, we keep trying a 100 times at most before abandoning the process
-        If the call for answers fails, we don't append the last batch of questions and we exit the loop to save the answered questions
-        """
-        
-        answer_retries = 1
-        while(answer_retries > 0):
-            # time.sleep(2)
-            answer_response = get_answers_by_id(session, df['accepted_answer_id'].to_list())
-            if(answer_response is not None):
-                break
-            answer_retries -= 1
+            df = df[df['accepted_answer_id'].notna()] # We keep only questions that have accepted answers
 
+            """
+            We use the get_answers_by_id function to retrieve answers for the questions of the page (the next page is being retrieved meanwhile)
+            If the call for answers fails, we don't write the last batch of questions and we stop
+            In embedded answers mode, the accepted answers are already in the page
+            """
+            if len(df) > 0 and embed_answers:
+                df_a = accepted_answers(df)
+                df = df.drop('answers', axis=1)
 
-        if answer_response is None:
-            print('Error: answer retrieval failed after 10 retries')
-            break
+                writer.write_page(df, df_a, page_from_date, next_from_date)
 
-        # Update from_date ONLY if the answers were successfully retrieved 
-        from_date = tmp_from_date
+            elif len(df) > 0:
+                answer_payload = get_answers_by_id(session, df['accepted_answer_id'].to_list(), api_key, limiter)
 
-        quota_remaining = answer_response.json()['quota_remaining']
-        answers_dict = answer_response.json()['items']
-        df_a = pd.DataFrame(answers_dict, columns=['last_activity_date', 'answer_id', 'question_id', 'body_markdown'])
-        df_a.drop('last_activity_date', axis=1, inplace=True)
+                if answer_payload is None:
+                    print('Error: answer retrieval failed')
+                    failed = True
+                    break
 
+                budget.update(answer_payload['quota_remaining'])
+                answers_dict = answer_payload['items']
+                df_a = pd.DataFrame(answers_dict, columns=['last_activity_date', 'answer_id', 'question_id', 'body_markdown'])
+                df_a.drop('last_activity_date', axis=1, inplace=True)
 
-        df0 = pd.concat([df0, df], ignore_index=True)
-        df0_a = pd.concat([df0_a, df_a], ignore_index=True)
+                writer.write_page(df, df_a, page_from_date, next_from_date)
 
+            else:
+                writer.skip_page(next_from_date)
 
-        if response.json()['has_more']:
-            time.sleep(2) # Sleep 2s not to abuse the API, 0.1s works fine but it can probably go lower
-        # In case there is no more data for the tag
+            # Update from_date ONLY once the page and its answers are on disk
+            if writer.durable_up_to is not None and writer.durable_up_to != checkpoint_date:
+                checkpoint_date = writer.durable_up_to
+                update_checkpoint(checkpoint_path, {checkpoint_key: checkpoint_date})
+    finally:
+        stop.set()
+        producer.join()
+        producer_session.close()
+
+        # The last parquet files are only readable once closed
+        writer.close()
+        if writer.durable_up_to is not None and writer.durable_up_to != checkpoint_date:
+            update_checkpoint(checkpoint_path, {checkpoint_key: writer.durable_up_to})
+
+    # In case there is no more data for the tag
+    if not has_more and not failed:
+        if to_date is not None:
+            # The crawler window is complete, the crawler marks the tag as done once all of its windows are
+            print("No more data for : " + tag_value + " before " + str(to_date))
+            update_checkpoint(checkpoint_path, {checkpoint_key: to_date})
         else:
             print("No more data for : " + tag_value)
             with open(schedule_path, 'r+') as f:
@@ -265,48 +368,15 @@ def fetch_data(session, tags, schedule_path, target_q_dir, target_a_dir, checkpo
             # We can change the tag_value right here in order to make a smart while loop that only stops when all the quota is consumed and switches from tag to tag
             with open(schedule_path, 'w') as file:
                 json.dump(sch, file, indent=4)
-            break
-        num_time_outs = 0
-
-
-
-    """
-    Update the checkpoint file with the latest date
-    """
-
-    with open(checkpoint_path, 'r+') as f:
-        if(os.path.getsize(checkpoint_path) == 0):
-            data ={}
-        else:
-            data = json.load(f)
-        
-        data[tag_value] = str(from_date)
-
-    with open(checkpoint_path, 'w') as f1:
-        json.dump(data, f1)
-
 
-    if not os.path.exists(target_q_dir):
-        os.makedirs(target_q_dir)
-    if not os.path.exists(target_a_dir):
-        os.makedirs(target_a_dir)
+    print(str(writer.pages) + " pages written for : " + tag_value)
 
-    target_q_csv = target_q_dir + '/' + tag_value + '_' + 'questions' + '_' +  str(from_date) + ".csv"
-    target_a_csv = target_a_dir + '/' + tag_value + '_'  + 'answers' + '_' + str(from_date) + '.csv'
-
-
-
-    df0.columns = ['tags', 'accepted_answer_id', 'answer_count', 'score', 'creation_date', 'question_id', 'title', 'body']
-    df0_a.columns = ['answer_id', 'question_id', 'body']
-
-    df0['body'] = df0['body'].apply(lambda x: BeautifulSoup(x, "html.parser").get_text())
-    df0_a['body'] = df0_a['body'].apply(lambda x: BeautifulSoup(x, "html.parser").get_text())
-
-
-    df0.to_csv(target_q_csv, sep=',', index=False, mode='a', header=not os.path.exists(target_q_csv))
-    df0_a.to_csv(target_a_csv, sep=',', index=False, mode='a', header=not os.path.exists(target_a_csv))
+    if failed and writer.pages == 0:
+        print("No data was saved")
+        return None
 
-    if(quota_remaining < 2):
+    if(budget.quota_remaining is not None and budget.quota_remaining < 2):
+        print("No more quota !")
         return False
 
     return True
@@ -316,253 +386,443 @@ def fetch_data(session, tags, schedule_path, target_q_dir, target_a_dir, checkpo
 
 """
 - Input : 
-    - file_path : path of the file we want to load into our Azure container
+    - questions_dir / answers_dir : directories of the staging files we want to load into our Azure containers
+    - copy_log : file listing the loaded files, read by copy_into_snowflake_table()
     - account_name : the name of the azure storage account we will use
-    - container_name : target container for blob loading
     - account_key : key of the account to grant access
+    - uploader : (optional) the BlobUploader to use, sharing one between runs keeps the blob indexes of the containers
+    - max_workers : number of files uploaded at the same time when no uploader is given
 
 - Process : 
-    - Uses the parameters to connect to the Azure account
-    - Terminates the process if the target file was already loaded in the cloud
-    - Verifies if the blob is already in the container and terminates the process in that case
-    - Otherwise, creates a new blob on Azure and fills it with the content of target file (gives the blob the same name as the file)
+    - Uses the parameters to connect to the Azure account (or to the AZURE_STORAGE_CONNECTION_STRING account, e.g. Azurite)
+    - Lists each container once and terminates the process if one of the files was already loaded in the cloud
+    - Otherwise, uploads the files in parallel, each one to a new blob with the same name as the file
+    - Verifies the upload results, removes the local files and appends their names to the copy log (also uploaded to the metadata container)
 
 """
 
 
-def load_into_cloud(questions_dir, answers_dir, copy_log, account_name, account_key):
-
-    storage_connection_string = 'DefaultEndpointsProtocol=https;AccountName=' + account_name + ';AccountKey=' + account_key + ';EndpointSuffix=core.windows.net'
+def load_into_cloud(questions_dir, answers_dir, copy_log, account_name, account_key, uploader=None, max_workers=8):
 
     qsts_files = os.listdir(questions_dir)
     ans_files = os.listdir(answers_dir)
 
     files = {}
 
+    # Files that are not staging files (e.g. an unfinished parquet file) are left out
     for file_name in qsts_files:
-        file_path = os.path.join(questions_dir, file_name)
-        files[file_path] = "question"
+        if staging_format_of(file_name) is not None:
+            file_path = os.path.join(questions_dir, file_name)
+            files[file_path] = "questions2"
 
     for file_name in ans_files:
-        file_path = os.path.join(answers_dir, file_name)
-        files[file_path] = "answer"
+        if staging_format_of(file_name) is not None:
+            file_path = os.path.join(answers_dir, file_name)
+            files[file_path] = "answers2"
 
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
+        if uploader is None:
+            uploader = BlobUploader(storage_connection_string(account_name, account_key), max_workers=max_workers)
     except Exception as e:
         print("Error while creating the blob service client")
         raise SystemExit(e)
 
     try:
-        qst_container_client = blob_service_client.get_container_client("questions2")
-        ans_container_client = blob_service_client.get_container_client("answers2")
+        for file_path, container_name in files.items():
+            blob_name = os.path.basename(file_path)
+            if uploader.exists(container_name, blob_name):
+                print(blob_name + " is already in Container : " + container_name)
+                return -1
     except Exception as e:
-        print("Error while creating the containers clients")
+        print(f"Error while listing the containers: {e}")
         raise SystemExit(e)
 
+    results = uploader.upload(files)
 
-    for file_path, file_type in files.items():
+    failed = [result for result in results if result['etag'] is None]
+    for result in failed:
+        print(result['blob_name'] + ' was not saved in ' + result['container'] + ' container : ' + str(result['error']))
+    if failed:
+        raise SystemExit
 
-        container_client = qst_container_client if file_type == "question" else ans_container_client
+    shutil.rmtree(questions_dir)
+    shutil.rmtree(answers_dir)
 
-        try:
+    with open(copy_log, 'a') as f:
+        for result in results:
+            f.write(result['blob_name'] + '\n')
 
-            blob_list0 = container_client.list_blobs()
+    result = uploader.upload_file("metadata", copy_log, blob_name=copy_log, overwrite=True)
+    if result['etag'] is None:
+        print(f"Error opening, appending or creating copy log in metadata container: {result['error']}")
+        raise SystemExit(result['error'])
 
-            blob_list = [item['name'] for item in blob_list0]
 
-            blob_name = file_path.split('/')[-1]
+"""
+Uses the snowflake python connector to create a snowflake stage and then links it to the azure storage account
+The connection is taken from manager (a ConnectionManager) if it is given, otherwise a connection is opened with the credentials
 
-            if blob_name in blob_list:
-                print(blob_name + " is already in Container : " + file_type + 's')
-                return -1
+"""
 
-            blob_client = container_client.get_blob_client(blob_name)
+def create_snowflake_stage(stage_name, snowflake_acc, snowflake_user, snowflake_password, snowflake_db, snowflake_schema, snowflake_wh, azure_container_name, azure_storage_acc, azure_sas_token, manager=None):
 
-            with open(file_path, "r") as local_file:
-                if not blob_client.exists():
-                    blob_client.upload_blob(local_file.read(), overwrite=True)
-                else:
-                    continue
+    create_stage_sql = f"""CREATE OR REPLACE STAGE {stage_name} URL = 'azure://{azure_storage_acc}.blob.core.windows.net/{azure_container_name}'
+    CREDENTIALS = (
+        AZURE_SAS_TOKEN='{azure_sas_token}'
+    );"""
 
-        except Exception as e:
-                print(f"Error while listing, checking or creating blob: {e}")
-                raise SystemExit(e)
+    with snowflake_session(manager, snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema) as conn:
+        conn.cursor().execute(create_stage_sql)
 
-    qst_list0 = qst_container_client.list_blobs()
-    ans_list0= ans_container_client.list_blobs()
 
-    qst_list = []
-    ans_list = []
+# Maximum number of files listed in the FILES option of a COPY INTO
+COPY_FILES_LIMIT = 1000
 
-    for item in qst_list0:
-        qst_list.append(item['name'])
 
-    for item in ans_list0:
-        ans_list.append(item['name'])
+"""
+Groups the files of the copy log by target : {(table_name, stage_name, file_format, copy_options): [file names]}
+"""
 
-    for file_path, file_type in files.items():
-        file_name = file_path.split('/')[-1]
-        if file_type == "question":
-            if file_name in qst_list:
-                continue
-            else:
-                print(file_name + ' was not saved in questions container')
-                raise SystemExit
-        else:
-            if file_name in ans_list:
-                continue
-            else:
-                print(file_name + ' was not saved in answers container')
-                raise SystemExit
+def plan_copies(file_names, file_format_name):
+    copies = {}
+    for file_name in file_names:
+        staging_format = STAGING_FORMATS[staging_format_of(file_name) or 'csv']
 
+        if 'questions' in file_name:
+            table_name = 'pfe2024.stackoverflow.temp_questions'
+            stage_name = 'azure_questions_stage'
+        else:
+            table_name = 'pfe2024.stackoverflow.temp_answers'
+            stage_name = 'azure_answers_stage'
 
-    shutil.rmtree(questions_dir)
-    shutil.rmtree(answers_dir)
+        target = (table_name, stage_name, staging_format['file_format'] or file_format_name, staging_format['copy_options'])
+        copies.setdefault(target, []).append(file_name)
+    return copies
 
-    list_of_names = [file_name.split('/')[-1] for file_name, file_type in files.items()]
 
-    with open(copy_log, 'a') as f:
-        for file_path, file_type in files.items():
-            f.write(file_path.split('/')[-1] + '\n')
+"""
+Loads the files of one target with COPY INTO ... FILES=(...), COPY_FILES_LIMIT files per statement, and returns the COPY output
+(one dict per file : file, status, rows_parsed, rows_loaded, errors_seen, first_error ...)
+"""
 
-    try:
-        container_client = blob_service_client.get_container_client("metadata")
-        blob_client = container_client.get_blob_client(copy_log)
+def copy_files(manager, table_name, stage_name, file_format, copy_options, file_names):
+    results = []
+    with manager.session() as conn:
+        for i in range(0, len(file_names), COPY_FILES_LIMIT):
+            files = ', '.join("'" + file_name.replace("'", "\\'") + "'" for file_name in file_names[i:i + COPY_FILES_LIMIT])
+            copy_into_sql = f"""COPY INTO {table_name} FROM @{stage_name} FILES = ({files}) ON_ERROR=CONTINUE FILE_FORMAT = (FORMAT_NAME = {file_format}) {copy_options};"""
+
+            cursor = conn.cursor()
+            try:
+                cursor.execute(copy_into_sql)
+                columns = [column[0].lower() for column in cursor.description]
+                for row in cursor.fetchall():
+                    result = dict(zip(columns, row))
+                    # Files already loaded (or no file at all) give a single 'status' row without a 'file' column
+                    if 'file' in result:
+                        result['table'] = table_name
+                        results.append(result)
+            finally:
+                cursor.close()
+    return results
 
-        with open(copy_log, "r") as local_file:
-            # if not blob_client.exists():
-            blob_client.upload_blob(local_file.read(), overwrite=True)
 
-    except Exception as e:
-            print(f"Error opening, appending or creating copy log in metadata container: {e}")
-            raise SystemExit(e)
+"""
+- Input : 
+    - copy_log : file listing the files loaded into the Azure containers by load_into_cloud()
+    - file_format_name : file format of the csv and gzip csv files (the file format of the other files depends on their staging format, see STAGING_FORMATS)
+    - Snowflake account credentials
+    - manager : (optional) the ConnectionManager to take the connections from, instead of connecting with the credentials
+    - copy_results : (optional) file (json lines) where the COPY INTO result of every file is appended
 
+- Process : 
+    - Empties the temp tables
+    - Copies the files of each table with as few COPY INTO ... FILES=(...) statements as possible (COPY_FILES_LIMIT files per statement)
+    - The tables are copied at the same time, each one on its own connection
+    - Records the result of every file and reports the files that were not fully loaded, then removes the copy log
+    - Returns the list of the file results
 
 """
-Uses the snowflake python connector to create a snowflake stage and then links it to the azure storage account
 
-"""
+def copy_into_snowflake_table(copy_log, file_format_name, snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema, manager=None, copy_results=None):
 
-def create_snowflake_stage(stage_name, snowflake_acc, snowflake_user, snowflake_password, snowflake_db, snowflake_schema, snowflake_wh, azure_container_name, azure_storage_acc, azure_sas_token):
+    with open(copy_log, "r") as f:
+        file_names = [line.strip() for line in f if line.strip()]
 
-    conn = snowflake.connector.connect(
-        user=snowflake_user,
-        password=snowflake_password,
-        account=snowflake_acc,
-        warehouse=snowflake_wh,
-        database=snowflake_db,
-        schema=snowflake_schema
-    )
+    copies = plan_copies(file_names, file_format_name)
 
-    create_stage_sql = f"""CREATE OR REPLACE STAGE {stage_name} URL = 'azure://{azure_storage_acc}.blob.core.windows.net/{azure_container_name}'
-    CREDENTIALS = (
-        AZURE_SAS_TOKEN='{azure_sas_token}'
-    );"""
+    owned = manager is None
+    if owned:
+        manager = snowflake_connection_manager(snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema, max_size=max(1, len(copies)))
 
-    conn.cursor().execute(create_stage_sql)
+    results = []
+    try:
+        manager.execute("""TRUNCATE TABLE pfe2024.stackoverflow.temp_questions;""")
+        manager.execute("""TRUNCATE TABLE pfe2024.stackoverflow.temp_answers;""")
 
-    conn.close()
+        if copies:
+            with ThreadPoolExecutor(max_workers=len(copies)) as executor:
+                futures = [executor.submit(copy_files, manager, *target, names) for target, names in copies.items()]
+                for future in futures:
+                    results += future.result()
 
+    except Exception as e:
+        print("Error while copying data into snowflake tables, terminating the process..")
+        raise SystemExit(e)
 
-"""
-Uses the snowflake python connector to copy data from an external stage into a table in snowflake
+    finally:
+        if owned:
+            manager.close()
 
-"""
+    not_loaded = [result for result in results if result.get('status') != 'LOADED']
+    for result in not_loaded:
+        print(f"{result['file']} : {result.get('status')}, {result.get('rows_loaded')}/{result.get('rows_parsed')} rows loaded, first error : {result.get('first_error')}")
+    statements = sum((len(names) + COPY_FILES_LIMIT - 1) // COPY_FILES_LIMIT for names in copies.values())
+    print(f"{len(results) - len(not_loaded)}/{len(file_names)} files loaded with {statements} COPY INTO")
 
-    
-def copy_into_snowflake_table(copy_log, file_format_name, snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema):
+    if copy_results is not None:
+        with open(copy_results, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result, default=str) + '\n')
 
-    conn = snowflake.connector.connect(
-            user=snowflake_user,
-            password=snowflake_password,
-            account=snowflake_acc,
-            warehouse=snowflake_wh,
-            database=snowflake_db,
-            schema=snowflake_schema
-        )
+    os.remove(copy_log)
 
+    return results
 
-    try:
-        conn.cursor().execute("""TRUNCATE TABLE pfe2024.stackoverflow.temp_questions;""")
-        conn.cursor().execute("""TRUNCATE TABLE pfe2024.stackoverflow.temp_answers;""")
 
-        with open(copy_log, "r") as f:
-            for file_path in f:
+# Temporary table of the staging rows of the batch being filled, read by the cache statistics and by the MERGE
+FILL_BATCH_TABLE = 'fill_batch'
 
-                if 'questions' in file_path:
-                    table_name = 'pfe2024.stackoverflow.temp_questions'
-                    stage_name = 'azure_questions_stage'
-                else:
-                    table_name = 'pfe2024.stackoverflow.temp_answers'
-                    stage_name = 'azure_answers_stage'     
+# Rows of FILL_BATCH_TABLE that get an embedding (the other ones only get their content hash, or are unchanged)
+EMBEDDED_ROWS = "action IN ('insert', 'embed')"
 
 
-                copy_into_sql = f"""COPY INTO {table_name} FROM @{stage_name}/{file_path} ON_ERROR=CONTINUE FILE_FORMAT = (FORMAT_NAME = {file_format_name});"""
+"""
+Returns the query that creates FILL_BATCH_TABLE with the staging rows whose answer_id is in (lower, upper] (one row per answer),
+their content hash, their cached embedding and what the MERGE does with them (action) :
+    - 'insert' : new answer, inserted with its embedding
+    - 'embed' : answer whose content hash changed (or without hash and with a new text), updated with a new embedding
+    - 'hash' : row of the final table without content hash (loaded before the hash existed) whose text did not change, it only gets its hash
+    - NULL : unchanged answer
+"""
 
-                conn.cursor().execute(copy_into_sql)
+def stage_batch_sql(lower, upper):
+    target_hash = CONTENT_HASH_SQL.format(q='t.question_body', a='t.answer_body')
+
+    return f"""
+    CREATE OR REPLACE TEMPORARY TABLE {FILL_BATCH_TABLE} AS
+    SELECT s0.*, c.embedding AS cached_embedding,
+        CASE
+            WHEN t.answer_id IS NULL THEN 'insert'
+            WHEN t.content_hash IS NULL AND {target_hash} = s0.content_hash THEN 'hash'
+            WHEN t.content_hash IS NULL OR t.content_hash <> s0.content_hash THEN 'embed'
+        END AS action
+    FROM (
+        SELECT
+            tag_list,
+            question_id,
+            answer_count,
+            score,
+            creation_date,
+            title,
+            question_body,
+            answer_id,
+            answer_body,
+            {CONTENT_HASH_SQL.format(q='question_body', a='answer_body')} AS content_hash
+        FROM stg_question_answer
+        WHERE answer_id > {int(lower)} AND answer_id <= {int(upper)}
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY answer_id ORDER BY creation_date DESC) = 1
+    ) s0
+    {cache_join_sql('s0.content_hash')}
+    LEFT JOIN question_answer t ON t.answer_id = s0.answer_id;
+    """
 
-    except Exception as e:
-        conn.close()
-        print("Error while copying data into snowflake tables, terminating the process..")
-        raise SystemExit(e)
-    
-    finally:
-        conn.close()
 
-    os.remove(copy_log)
+"""
+Returns the MERGE of the rows of FILL_BATCH_TABLE into the final table, following their action (see stage_batch_sql()),
+the embeddings are taken from the embedding cache when the content hash is in it
+"""
+
+def merge_batch_sql():
+    embedding = cached_embedding_sql('s.cached_embedding', 's.question_body', 's.answer_body')
+
+    return f"""
+    MERGE INTO question_answer t
+    USING (SELECT * FROM {FILL_BATCH_TABLE} WHERE action IS NOT NULL) s
+    ON t.answer_id = s.answer_id
+    WHEN MATCHED AND s.action = 'hash' THEN UPDATE SET
+        content_hash = s.content_hash
+    WHEN MATCHED AND s.action = 'embed' THEN UPDATE SET
+        tag_list = s.tag_list,
+        question_id = s.question_id,
+        answer_count = s.answer_count,
+        score = s.score,
+        creation_date = s.creation_date,
+        title = s.title,
+        question_body = s.question_body,
+        answer_body = s.answer_body,
+        question_answer_embedding = {embedding},
+        content_hash = s.content_hash,
+        updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN INSERT (TAG_LIST, QUESTION_ID, ANSWER_COUNT, SCORE, CREATION_DATE, TITLE, QUESTION_BODY, ANSWER_ID, ANSWER_BODY,
+        QUESTION_ANSWER_EMBEDDING, CONTENT_HASH, UPDATED_AT)
+    VALUES (s.tag_list, s.question_id, s.answer_count, s.score, s.creation_date, s.title, s.question_body, s.answer_id, s.answer_body,
+        {embedding}, s.content_hash, CURRENT_TIMESTAMP());
+    """
+
 
-  
 """
 - Input : 
     - Snowflake account credentials
+    - manager : (optional) the ConnectionManager to take the connection from, instead of connecting with the credentials
+    - mode : 'incremental' (default) merges the staging rows batch by batch, 'full' inserts every staging row at once (original behaviour)
+    - batch_size : number of answers merged per batch in incremental mode
+    - progress_path : file where the incremental mode saves the last merged answer_id
+    - cache : (optional) the EmbeddingCache that counts the embedding cache hits and misses (one per embedded row, see cache_stats_sql())
+    - chunks : if True, the posts are also split into overlapping chunks embedded one by one in the question_answer_chunks table,
+      the fill stops before writing anything if that table does not exist
+    - chunk_size, chunk_overlap : number of characters of a chunk and of the overlap of two consecutive chunks
 
 - Process : 
     - Uses the credentials to connect to Snowflake account
     - Uses the python connector to insert data from the stg_question_answer table (staging table) into the final table (question_answer)
-    - Calls the EMBED_TEXT_768 function inside the query on the concatenation of question_body and answer_body fields to fill the vector column
+    - Calls the EMBED_TEXT_768 function inside the query on the concatenation of question_body and answer_body fields to fill the vector column,
+      unless the embedding of the same text is in the embedding cache (keyed by model and content hash)
+    - Adds the embeddings of the loaded rows to the embedding cache
+    - Chunks the new and changed posts and embeds every chunk (see sync_chunks_sql()), e5-base-v2 only reads the first 512 tokens of a text
+    - In incremental mode :
+        - The staging rows are copied by answer_id ranges of batch_size answers into a temporary table with their cached embedding and action
+          (see stage_batch_sql()), then merged (see merge_batch_sql()) : only the new and changed answers are embedded
+        - Each batch is merged, cached and chunked in one transaction, then saved in the progress file with a fingerprint of the staging table,
+          an interrupted fill resumes after the last merged batch as long as the staging table did not change
 
 """
 
-def fill_final_table(snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema):
-    conn = snowflake.connector.connect(
-        user=snowflake_user,
-        password=snowflake_password,
-        account=snowflake_acc,
-        warehouse=snowflake_wh,
-        database=snowflake_db,
-        schema=snowflake_schema
-    )
-    
+def fill_final_table(snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema, manager=None, mode='incremental', batch_size=50000, progress_path='fill_progress.json', cache=None, chunks=False, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+
+    cache = cache if cache is not None else EmbeddingCache(manager)
+
+    if mode == 'incremental':
+        try:
+            with snowflake_session(manager, snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema) as conn:
+                cursor = conn.cursor()
+                try:
+                    if chunks and not chunk_table_exists(cursor):
+                        print(f"The {CHUNK_TABLE} table does not exist (see tables.sql), the final table is not filled")
+                        return
+
+                    cursor.execute("""SELECT COUNT(*), HASH_AGG(*) FROM stg_question_answer;""")
+                    row_count, fingerprint = cursor.fetchone()
+                    fingerprint = str(row_count) + ':' + str(fingerprint)
+
+                    progress = load_checkpoint(progress_path)
+                    last_answer_id = int(progress['last_answer_id']) if progress.get('fingerprint') == fingerprint else -1
+                    if last_answer_id >= 0:
+                        print("Resuming the fill of the final table after answer_id " + str(last_answer_id))
+
+                    inserted = 0
+                    updated = 0
+                    while True:
+                        cursor.execute("""SELECT MAX(answer_id) FROM (SELECT answer_id FROM stg_question_answer WHERE answer_id > %s ORDER BY answer_id LIMIT %s);""", (last_answer_id, batch_size))
+                        upper = cursor.fetchone()[0]
+                        if upper is None:
+                            break
+
+                        # The batch is staged before the transaction (a CREATE commits the open transaction on Snowflake),
+                        # its cache hits and misses are the rows that join a cached embedding and the ones that call EMBED_TEXT_768
+                        cursor.execute(stage_batch_sql(last_answer_id, upper))
+                        hits, misses = cache.count(cursor, FILL_BATCH_TABLE, EMBEDDED_ROWS)
+
+                        # The MERGE, the cache fill and the chunks of a batch are committed together
+                        cursor.execute("BEGIN")
+                        try:
+                            cursor.execute(merge_batch_sql())
+                            result = cursor.fetchone()
+                            cursor.execute(fill_cache_sql(f"t.answer_id > {int(last_answer_id)} AND t.answer_id <= {int(upper)}"))
+                            if chunks:
+                                for query in sync_chunks_sql(f"t.answer_id > {int(last_answer_id)} AND t.answer_id <= {int(upper)}", chunk_size, chunk_overlap):
+                                    cursor.execute(query)
+                            conn.commit()
+                        except Exception:
+                            conn.rollback()
+                            raise
+                        inserted += result[0]
+                        updated += result[1]
+
+                        last_answer_id = upper
+                        update_checkpoint(progress_path, {'fingerprint': fingerprint, 'last_answer_id': last_answer_id})
+                    cursor.execute(f"DROP TABLE IF EXISTS {FILL_BATCH_TABLE}")
+                finally:
+                    cursor.close()
+
+            print(f"Final table up to date : {inserted} answers inserted, {updated} answers updated.")
+            print(f"Embedding cache : {cache.stats()}")
+
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        return
+
+
     try:
-        cursor = conn.cursor()
+        with snowflake_session(manager, snowflake_user, snowflake_password, snowflake_acc, snowflake_wh, snowflake_db, snowflake_schema) as conn:
+            cursor = conn.cursor()
+
+            # Every staging row is inserted with an embedding : the cache is joined once, in the temporary table that the
+            # statistics and the INSERT both read
+            stage_query = f"""
+            CREATE OR REPLACE TEMPORARY TABLE {FILL_BATCH_TABLE} AS
+            SELECT s.*, c.embedding AS cached_embedding
+            FROM (
+                SELECT stg.*, {CONTENT_HASH_SQL.format(q='question_body', a='answer_body')} AS content_hash
+                FROM stg_question_answer stg
+            ) s
+            {cache_join_sql('s.content_hash')};
+            """
+
+            update_query = f"""
+            INSERT INTO question_answer (TAG_LIST, QUESTION_ID, ANSWER_COUNT, SCORE, CREATION_DATE, TITLE, QUESTION_BODY, ANSWER_ID, ANSWER_BODY,
+            QUESTION_ANSWER_EMBEDDING, CONTENT_HASH, UPDATED_AT)
+            SELECT
+                s.tag_list,
+                s.question_id,
+                s.answer_count,
+                s.score,
+                s.creation_date,
+                s.title,
+                s.question_body,
+                s.answer_id,
+                s.answer_body,
+                {cached_embedding_sql('s.cached_embedding', 's.question_body', 's.answer_body')} AS question_answer_embedding,
+                s.content_hash,
+                CURRENT_TIMESTAMP() AS updated_at
+            FROM {FILL_BATCH_TABLE} s;
+            """
+
+            try:
+                if chunks and not chunk_table_exists(cursor):
+                    print(f"The {CHUNK_TABLE} table does not exist (see tables.sql), the final table is not filled")
+                    return
+
+                cursor.execute(stage_query)
+                cache.count(cursor, FILL_BATCH_TABLE)
+
+                cursor.execute("BEGIN")
+                try:
+                    cursor.execute(update_query)
+                    cursor.execute(fill_cache_sql("TRUE"))
+                    if chunks:
+                        for query in sync_chunks_sql("TRUE", chunk_size, chunk_overlap):
+                            cursor.execute(query)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                cursor.execute(f"DROP TABLE IF EXISTS {FILL_BATCH_TABLE}")
+            finally:
+                cursor.close()
+
+            print("Data Moved to the final table successfully.")
+            print(f"Embedding cache : {cache.stats()}")
 
-        update_query = f"""
-        INSERT INTO question_answer (TAG_LIST, QUESTION_ID, ANSWER_COUNT, SCORE, CREATION_DATE, TITLE, QUESTION_BODY, ANSWER_ID, ANSWER_BODY,
-	    QUESTION_ANSWER_EMBEDDING)
-        SELECT
-            tag_list,
-            question_id,
-            answer_count,
-            score,
-            creation_date,
-            title,
-            question_body,
-            answer_id,
-            answer_body,
-            SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', CONCAT(question_body, ' ', answer_body)) AS question_answer_embedding
-        FROM stg_question_answer;
-        """
-        
-        cursor.execute(update_query)
-        
-        conn.commit()
-        
-        print("Data Moved to the final table successfully.")
-    
     except Exception as e:
         print(f"An error occurred: {e}")
-    
-    finally:
-        cursor.close()
-        conn.close()
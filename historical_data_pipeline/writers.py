@@ -0,0 +1,186 @@
+import os
+import pandas as pd
+from cleaning import CleaningStage
+
+
+# Columns of the files loaded into the temp_questions and temp_answers tables (the order matters for the csv file format)
+QUESTION_COLUMNS = ['tags', 'accepted_answer_id', 'answer_count', 'score', 'creation_date', 'question_id', 'title', 'body']
+ANSWER_COLUMNS = ['answer_id', 'question_id', 'body']
+
+"""
+Staging formats supported from the writer to the COPY INTO :
+    - extension : extension of the files written by the PageWriter
+    - file_format : Snowflake file format used to load the files, None means the csv file format given to copy_into_snowflake_table()
+      (its COMPRESSION=AUTO also reads the gzip files)
+    - copy_options : additional options of the COPY INTO
+    - durable_pages : True if every page is readable on disk as soon as it is written, a parquet file is only readable once closed
+"""
+STAGING_FORMATS = {
+    'csv': {
+        'extension': '.csv',
+        'file_format': None,
+        'copy_options': '',
+        'durable_pages': True
+    },
+    'csv.gz': {
+        'extension': '.csv.gz',
+        'file_format': None,
+        'copy_options': '',
+        'durable_pages': True
+    },
+    'parquet': {
+        'extension': '.parquet',
+        'file_format': 'stackexchange_parquet_ff',
+        'copy_options': 'MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE',
+        'durable_pages': False
+    }
+}
+
+# Parquet files are loaded by column name, so their columns are named after the columns of the temp tables
+PARQUET_RENAMES = {'tags': 'tag_list'}
+
+# Suffix of a parquet file that is still being written, it is renamed once the file is closed
+PART_SUFFIX = '.part'
+
+
+"""
+Returns the staging format of a file from its name (None if the file is not a staging file, e.g. an unfinished parquet file)
+"""
+
+def staging_format_of(file_name):
+    # Longest extensions first so that '.csv.gz' is not taken for '.csv'
+    for name, staging_format in sorted(STAGING_FORMATS.items(), key=lambda item: -len(item[1]['extension'])):
+        if file_name.endswith(staging_format['extension']):
+            return name
+    return None
+
+
+"""
+Streaming writer used by fetch_data() to spill every page of questions and answers to disk as soon as it is retrieved
+
+Input :
+    - target_q_dir / target_a_dir : directories of the questions and answers files
+    - tag_value : the tag(s) of the questions, used in the file names
+    - rows_per_file : number of questions after which a new pair of files is started
+    - cleaning_stage : (optional) the CleaningStage applied to the bodies, the fast in-process cleaner by default
+    - staging_format : 'csv' (default), 'csv.gz' or 'parquet' (see STAGING_FORMATS)
+    - compression : compression codec of the parquet files ('snappy' or 'zstd')
+    - row_group_size : number of rows buffered before a parquet row group is written
+
+Process :
+    - write_page() cleans the bodies of one page (and splits their code blocks into a 'code' column if the stage asks for it) and appends it to the current questions and answers files
+    - The files are named after the from_date of their first page : <tag>_questions_<from_date>.<extension> and <tag>_answers_<from_date>.<extension>
+    - Once the current files hold rows_per_file questions, the next page starts a new pair of files (rolling output)
+    - csv and gzip csv pages are appended to the files right away (a gzip csv file is a sequence of gzip members, one per page)
+    - parquet pages are buffered into row groups and written to a '.part' file that is renamed once closed (on roll or close())
+    - durable_up_to is the next from_date of the last page that is readable on disk (or skipped with skip_page()), the checkpoint
+      can only move up to it : it follows every page in csv, and every closed file in parquet
+"""
+
+class PageWriter:
+
+    def __init__(self, target_q_dir, target_a_dir, tag_value, rows_per_file=50000, cleaning_stage=None, staging_format='csv', compression='snappy', row_group_size=10000):
+        if staging_format not in STAGING_FORMATS:
+            raise ValueError("Unknown staging format : " + str(staging_format) + ", expected one of " + str(list(STAGING_FORMATS)))
+        self.target_q_dir = target_q_dir
+        self.target_a_dir = target_a_dir
+        self.tag_value = tag_value
+        self.rows_per_file = rows_per_file
+        self.cleaning_stage = cleaning_stage if cleaning_stage is not None else CleaningStage()
+        self.staging_format = staging_format
+        self.extension = STAGING_FORMATS[staging_format]['extension']
+        self.compression = compression
+        self.row_group_size = row_group_size
+
+        self.q_path = None
+        self.a_path = None
+        self.rows_in_file = 0
+        self.pages = 0
+        self.files = []
+        self.written_up_to = None
+        self.durable_up_to = None
+
+        # parquet only : the open writers and the pages waiting to be written as a row group
+        self._parquet_writers = {}
+        self._buffers = {}
+
+    def roll(self, from_date):
+        self.close()
+
+        if not os.path.exists(self.target_q_dir):
+            os.makedirs(self.target_q_dir, exist_ok=True)
+        if not os.path.exists(self.target_a_dir):
+            os.makedirs(self.target_a_dir, exist_ok=True)
+
+        self.q_path = self.target_q_dir + '/' + self.tag_value + '_' + 'questions' + '_' + str(from_date) + self.extension
+        self.a_path = self.target_a_dir + '/' + self.tag_value + '_' + 'answers' + '_' + str(from_date) + self.extension
+        self.files += [self.q_path, self.a_path]
+        self.rows_in_file = 0
+
+    def write_page(self, df_q, df_a, from_date, next_from_date):
+        if self.q_path is None or self.rows_in_file >= self.rows_per_file:
+            self.roll(from_date)
+
+        df_q = df_q.copy()
+        df_a = df_a.copy()
+        df_q.columns = QUESTION_COLUMNS
+        df_a.columns = ANSWER_COLUMNS
+        # accepted_answer_id is a float column because of the questions without accepted answer, they are filtered out at this point
+        df_q['accepted_answer_id'] = df_q['accepted_answer_id'].astype('int64')
+
+        df_q = self.cleaning_stage.clean_frame(df_q)
+        df_a = self.cleaning_stage.clean_frame(df_a)
+
+        if self.staging_format == 'parquet':
+            self.buffer(self.q_path, df_q)
+            self.buffer(self.a_path, df_a)
+        else:
+            compression = 'gzip' if self.staging_format == 'csv.gz' else None
+            df_q.to_csv(self.q_path, sep=',', index=False, mode='a', header=not os.path.exists(self.q_path), compression=compression)
+            df_a.to_csv(self.a_path, sep=',', index=False, mode='a', header=not os.path.exists(self.a_path), compression=compression)
+
+        self.rows_in_file += len(df_q)
+        self.pages += 1
+        self.written_up_to = next_from_date
+        if STAGING_FORMATS[self.staging_format]['durable_pages']:
+            self.durable_up_to = next_from_date
+
+    def skip_page(self, next_from_date):
+        # A page without any accepted answer, nothing to write but the checkpoint has to move past it
+        self.written_up_to = next_from_date
+        if STAGING_FORMATS[self.staging_format]['durable_pages'] or not (self._buffers or self._parquet_writers):
+            self.durable_up_to = next_from_date
+
+    def buffer(self, path, df):
+        self._buffers.setdefault(path, []).append(df)
+        if sum(len(page) for page in self._buffers[path]) >= self.row_group_size:
+            self.write_row_group(path)
+
+    def write_row_group(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pages = self._buffers.pop(path, [])
+        if not pages:
+            return
+
+        df = pd.concat(pages, ignore_index=True).rename(columns=PARQUET_RENAMES)
+        if 'tag_list' in df.columns:
+            # Same text as in the csv files, the column is a VARCHAR in the temp table
+            df['tag_list'] = df['tag_list'].astype(str)
+        if path in self._parquet_writers:
+            # Every row group of a file has to follow the schema of the first one
+            table = pa.Table.from_pandas(df, schema=self._parquet_writers[path].schema, preserve_index=False)
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self._parquet_writers[path] = pq.ParquetWriter(path + PART_SUFFIX, table.schema, compression=self.compression)
+        self._parquet_writers[path].write_table(table)
+
+    def close(self):
+        for path in list(self._buffers):
+            self.write_row_group(path)
+        for path, parquet_writer in self._parquet_writers.items():
+            parquet_writer.close()
+            os.replace(path + PART_SUFFIX, path)
+        self._parquet_writers = {}
+        self.durable_up_to = self.written_up_to
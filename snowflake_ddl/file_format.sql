@@ -12,4 +12,11 @@ REPLACE_INVALID_CHARACTERS=FALSE
 DATE_FORMAT=AUTO
 TIME_FORMAT=AUTO
 TIMESTAMP_FORMAT=AUTO
-error_on_column_count_mismatch=false;
+error_on_column_count_mismatch=false
+COMPRESSION=AUTO; -- also reads the gzip csv files (staging_format "csv.gz")
+
+-- Used for the parquet files (staging_format "parquet"), the columns are matched by name in the COPY INTO
+
+CREATE OR REPLACE FILE FORMAT stackexchange_parquet_ff
+TYPE=PARQUET
+COMPRESSION=AUTO;
@@ -1,42 +1,44 @@
+-- Stage of the python modules imported by the procedures, context_packer.py of the app must be uploaded to it before the procedure
+-- is created (with SnowSQL, from the root of the repository) :
+-- PUT file://snowflake_streamlit/context_packer.py @PFE2024.STACKOVERFLOW.CODE_STAGE AUTO_COMPRESS = FALSE OVERWRITE = TRUE;
+CREATE STAGE IF NOT EXISTS PFE2024.STACKOVERFLOW.CODE_STAGE;
+
 CREATE OR REPLACE PROCEDURE PFE2024.STACKOVERFLOW.GENERATE_NEWSLETTER()
 RETURNS VARCHAR(16777216)
 LANGUAGE PYTHON
 RUNTIME_VERSION = '3.8'
 PACKAGES = ('snowflake-snowpark-python','requests')
+IMPORTS = ('@PFE2024.STACKOVERFLOW.CODE_STAGE/context_packer.py')
 HANDLER = 'generate_content'
 EXECUTE AS CALLER
 AS '
 import snowflake.snowpark as snowpark
 import requests
+import logging
+
+from context_packer import pack_context, context_budget, estimate_tokens
+
+logger = logging.getLogger("generate_newsletter")
+
+MODEL = ''llama3-70b''
+# Same cap as max_context_tokens of the app : the context gets at most this many tokens of what the context window
+# of the model leaves to it once the template and the newsletter are accounted for
+MAX_CONTEXT_TOKENS = 6000
 
 
 def get_top_questions(session):
     cmd = """
     SELECT QUESTION_BODY, ANSWER_BODY, QUESTION_ID
     FROM pfe2024.stackoverflow.stackoverflow_weekly
-    ORDER BY VIEW_COUNT DESC
+    ORDER BY VIEW_COUNT DESC NULLS LAST
     LIMIT 5
     """
     df_top_questions = session.sql(cmd).to_pandas()
     return df_top_questions
 
 
-def create_prompt(session):
-    df_context = get_top_questions(session)
-
-    context_length = len(df_context)
-    prompt_context = ""
-    question_ids = []
-
-    for i in range(context_length):
-        prompt_context += df_context._get_value(i, ''QUESTION_BODY'')
-        prompt_context += "\\n"
-        prompt_context += df_context._get_value(i, ''ANSWER_BODY'')
-        question_ids.append(df_context._get_value(i, ''QUESTION_ID''))
-
-    prompt_context = prompt_context.replace("''", "")
-
-    prompt =  f"""
+def prompt_template(prompt_context):
+    return f"""
         Generate a StackOverflow Weekly Newsletter using the following structure:
         Start with this introduction:
         "Welcome to this issue of the StackOverflow Weekly Newsletter! This week, we explore some of the most engaging discussions in the programming community. Whether you''re a seasoned developer or just starting out, we hope you find these insights both informative and inspiring."
@@ -51,7 +53,18 @@ def create_prompt(session):
         Avoid using explicit section headers like "Introduction," "Content," or "Conclusion." Ensure the content flows naturally as a single, unified piece of writing.
 
         """
-    
+
+
+def create_prompt(session):
+    df_context = get_top_questions(session)
+
+    # Packed by the context_packer.py of the app (imported from CODE_STAGE), so the newsletter and the app trim the same way
+    posts = [{"question_body": row.QUESTION_BODY, "answer_body": row.ANSWER_BODY, "question_id": row.QUESTION_ID} for row in df_context.itertuples()]
+    budget = context_budget(MODEL, estimate_tokens(prompt_template(""), MODEL), MAX_CONTEXT_TOKENS)
+    prompt_context, question_ids, report = pack_context(posts, MODEL, budget)
+    prompt = prompt_template(prompt_context.replace("''", ""))
+
+    logger.info(f"Prompt : ~{estimate_tokens(prompt, MODEL)} tokens, context : ~{report[''context_tokens'']} / {budget} tokens, {report[''trimmed_bodies'']} bodies trimmed")
     return prompt, question_ids
 
 
@@ -61,14 +74,14 @@ def complete(session):
     cmd = f"""
     select SNOWFLAKE.CORTEX.COMPLETE(?,?) as response
     """
-    df_response = session.sql(cmd, params=[''llama3-70b'', prompt]).collect()
+    df_response = session.sql(cmd, params=[MODEL, prompt]).collect()
     return df_response, question_ids
     
 
 def generate_content(session: snowpark.Session) -> str:
 
     df_response, question_ids = complete(session)
-    model_name = ''llama3-70b''
+    model_name = MODEL
     query = "Weekly newsletter"
     res_text = df_response[0].RESPONSE
     session.sql(f"""
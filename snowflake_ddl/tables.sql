@@ -12,13 +12,15 @@ create or replace TABLE TEMP_QUESTIONS (
 	CREATION_DATE NUMBER(38,0),
 	QUESTION_ID NUMBER(38,0),
 	TITLE VARCHAR(500),
-	BODY VARCHAR(100000)
+	BODY VARCHAR(100000),
+	CODE VARCHAR(100000) -- only filled when the pipeline runs with split_code_blocks
 );
 
 create or replace TABLETEMP_ANSWERS (
 	ANSWER_ID NUMBER(38,0),
 	QUESTION_ID NUMBER(38,0),
-	BODY VARCHAR(100000)
+	BODY VARCHAR(100000),
+	CODE VARCHAR(100000) -- only filled when the pipeline runs with split_code_blocks
 );
 
 -- The staging table
@@ -47,9 +49,45 @@ create or replace TABLE QUESTION_ANSWER (
 	QUESTION_BODY VARCHAR(1000000),
 	ANSWER_ID NUMBER(38,0),
 	ANSWER_BODY VARCHAR(1000000),
-	QUESTION_ANSWER_EMBEDDING VECTOR(FLOAT, 768)
+	QUESTION_ANSWER_EMBEDDING VECTOR(FLOAT, 768),
+	CONTENT_HASH VARCHAR(64), -- SHA2 of the embedded text, an answer is only embedded again if it changes
+	UPDATED_AT TIMESTAMP_NTZ
 );
 
+-- On an existing final table, add the columns instead and remove the duplicated answers of the previous loads :
+-- ALTER TABLE QUESTION_ANSWER ADD COLUMN IF NOT EXISTS CONTENT_HASH VARCHAR(64);
+-- ALTER TABLE QUESTION_ANSWER ADD COLUMN IF NOT EXISTS UPDATED_AT TIMESTAMP_NTZ;
+-- CREATE OR REPLACE TABLE QUESTION_ANSWER AS SELECT * FROM QUESTION_ANSWER QUALIFY ROW_NUMBER() OVER (PARTITION BY ANSWER_ID ORDER BY ANSWER_ID) = 1;
+
+-- The chunks of the posts, e5-base-v2 only reads the first 512 tokens of a text : every post is split into overlapping chunks
+-- of 1200 characters that are embedded one by one (with the title of the question)
+
+create or replace TABLE QUESTION_ANSWER_CHUNKS (
+	ANSWER_ID NUMBER(38,0),
+	QUESTION_ID NUMBER(38,0),
+	CHUNK_NO NUMBER(38,0),
+	CHUNK_TEXT VARCHAR(16777216),
+	CHUNK_EMBEDDING VECTOR(FLOAT, 768),
+	CONTENT_HASH VARCHAR(64), -- content hash of the post when it was chunked, its chunks are replaced when it changes
+	UPDATED_AT TIMESTAMP_NTZ,
+	PRIMARY KEY (ANSWER_ID, CHUNK_NO)
+)
+CLUSTER BY (ANSWER_ID);
+
+-- The embedding cache, an embedding is computed once per model and content hash (SHA2 of the normalized question_body + answer_body)
+
+create or replace TABLE EMBEDDING_CACHE (
+	MODEL VARCHAR(100),
+	CONTENT_HASH VARCHAR(64),
+	EMBEDDING VECTOR(FLOAT, 768),
+	CREATED_AT TIMESTAMP_NTZ
+)
+CLUSTER BY (MODEL, CONTENT_HASH);
+
+-- To seed the cache with the embeddings already computed (once the content hashes are filled) :
+-- INSERT INTO EMBEDDING_CACHE SELECT 'e5-base-v2', CONTENT_HASH, QUESTION_ANSWER_EMBEDDING, CURRENT_TIMESTAMP() FROM QUESTION_ANSWER
+-- WHERE CONTENT_HASH IS NOT NULL QUALIFY ROW_NUMBER() OVER (PARTITION BY CONTENT_HASH ORDER BY ANSWER_ID) = 1;
+
 
 -- The newsletters table
 
@@ -57,12 +95,43 @@ create or replace TABLE NEWSLETTERS (
 	QUERY VARCHAR(16777216),
 	MODEL VARCHAR(16777216),
 	CREATION_DATE TIMESTAMP_LTZ(9),
-	NEWSLETTER_BODY VARCHAR(16777216)
+	NEWSLETTER_BODY VARCHAR(16777216),
+	MODE VARCHAR(100),
+	CONTEXT_QUESTION_IDS VARCHAR(16777216),
+	CACHE_KEY VARCHAR(64) -- SHA256 of (mode, normalized theme, model, context question ids), a stored newsletter is reused instead of generated again
 );
 
+-- On an existing newsletters table, add the columns instead :
+-- ALTER TABLE NEWSLETTERS ADD COLUMN IF NOT EXISTS MODE VARCHAR(100);
+-- ALTER TABLE NEWSLETTERS ADD COLUMN IF NOT EXISTS CONTEXT_QUESTION_IDS VARCHAR(16777216);
+-- ALTER TABLE NEWSLETTERS ADD COLUMN IF NOT EXISTS CACHE_KEY VARCHAR(64);
+
 -- The stackoverflow weekly data table 
 
 create or replace TABLE STACKOVERFLOW_WEEKLY (
+	TAGS VARCHAR(16777216),
+	TITLE VARCHAR(16777216),
+	QUESTION_BODY VARCHAR(16777216),
+	ANSWER_BODY VARCHAR(16777216),
+	QUESTION_ID NUMBER(38,0),
+	QUESTION_CREATION_DATE NUMBER(38,0),
+	QUESTION_SCORE NUMBER(38,0),
+	FAVORITE_COUNT NUMBER(38,0),
+	QUESTION_UPVOTE_COUNT NUMBER(38,0),
+	VIEW_COUNT NUMBER(38,0),
+	ANSWER_UPVOTE_COUNT NUMBER(38,0),
+	ANSWER_SCORE NUMBER(38,0),
+	ANSWER_ID NUMBER(38,0),
+	ANSWER_CREATION_DATE NUMBER(38,0),
+	LOADED_AT TIMESTAMP_NTZ -- last time the row was inserted or changed by the weekly load
+);
+
+-- On an existing stackoverflow weekly table, add the column instead :
+-- ALTER TABLE STACKOVERFLOW_WEEKLY ADD COLUMN IF NOT EXISTS LOADED_AT TIMESTAMP_NTZ;
+
+-- The staging table of the weekly load, merged into STACKOVERFLOW_WEEKLY on answer_id
+
+create or replace TRANSIENT TABLE STACKOVERFLOW_WEEKLY_STAGING (
 	TAGS VARCHAR(16777216),
 	TITLE VARCHAR(16777216),
 	QUESTION_BODY VARCHAR(16777216),
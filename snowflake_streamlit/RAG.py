@@ -1,44 +1,233 @@
 import streamlit as st
+import os
+import json
 import time
+import datetime
+import threading
 from snowflake.snowpark.context import get_active_session
 session = get_active_session()
 
 import pandas as pd
+from vector_index import refresh as refresh_index
+from lexical_index import refresh as refresh_titles
+from quantized_store import QuantizedStore, export_store, store_identity
+from query_cache import RetrievalCache, normalize_query, newsletter_key
+from context_packer import pack_context, context_budget, estimate_tokens
 
 pd.set_option("max_colwidth", None)
 num_chunks = 5  # Num-chunks provided as context.
+index_refresh_seconds = 600  # The local index picks up the new rows of question_answer at most this often
+store_directory = '/tmp/question_answer_store'  # Memory-mapped by every worker of the app, so they share one page-cached copy
+store_refresh_seconds = 86400  # The quantized store is exported again once it is older than this
+title_candidates = 500  # Number of BM25 title matches reranked by vector similarity when the title prefilter is on
+filter_overfetch = 20  # With filters, the local retrievers fetch this many times num_chunks results before filtering them
+max_filter_candidates = 20000  # ... and widen their search (4 times more results each round) up to this many results until num_chunks posts match
+chunk_hits_per_post = 3  # The Chunks retriever keeps up to this many chunks of a post as its snippets
+max_context_tokens = 6000  # Token budget of the retrieved posts in a prompt (cost and time-to-first-token), capped by the context window of the model
 
-def create_prompt(myquestion, rag, df_context=None):
-    if rag == 1:    
-        if df_context is None:
-            cmd = """
-            with results as
-            (SELECT DISTINCT
-                QUESTION_ID,
-                VECTOR_COSINE_SIMILARITY(question_answer.question_answer_embedding,
-                        SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', ?)) as similarity,
-                question_body, answer_body
-            from question_answer
-            order by similarity desc
-            limit ?)
-            select question_body, answer_body, question_id from results 
-            """
-            df_context = session.sql(cmd, params=[myquestion, num_chunks]).to_pandas()
-        
-        context_length = len(df_context)
-        prompt_context = ""
-        question_ids = []
 
-        for i in range(context_length):
-            prompt_context += df_context._get_value(i, 'QUESTION_BODY')
-            prompt_context += "\n"
-            prompt_context += df_context._get_value(i, 'ANSWER_BODY')
-            question_ids.append(df_context._get_value(i, 'QUESTION_ID'))
+@st.cache_resource
+def get_index_holder():
+    # Shared by every session of the app, the index is built on the first query and then refreshed incrementally
+    return {'index': None, 'lock': threading.Lock()}
 
-        prompt_context = prompt_context.replace("'", "")
 
+def search_index(query_embedding, k, allowed=None, widen=1):
+    holder = get_index_holder()
+    with holder['lock']:
+        index = holder['index']
+        if index is None or time.time() - index.refreshed_at > index_refresh_seconds:
+            index = holder['index'] = refresh_index(session, index)
+    # A widened search also probes more lists, so that they hold the k results
+    return index.search(query_embedding, k, index.n_probe * widen, allowed)
 
-        prompt = f"""
+
+@st.cache_resource
+def get_titles_holder():
+    return {'index': None, 'lock': threading.Lock()}
+
+
+def search_titles(myquestion):
+    holder = get_titles_holder()
+    with holder['lock']:
+        index = holder['index']
+        if index is None or time.time() - index.refreshed_at > index_refresh_seconds:
+            index = holder['index'] = refresh_titles(session, index)
+    return index.search(myquestion, title_candidates)[0]
+
+
+@st.cache_resource
+def get_store_holder():
+    return {'store': None, 'lock': threading.Lock()}
+
+
+def search_store(query_embedding, k, allowed=None):
+    holder = get_store_holder()
+    with holder['lock']:
+        expired = not os.path.exists(store_directory) or time.time() - os.path.getmtime(store_directory) > store_refresh_seconds
+        if expired:
+            export_store(session, store_directory)
+        # Another worker may have exported a newer store : the store is reopened whenever the directory behind the symlink changed
+        if holder['store'] is None or holder['store'].identity != store_identity(store_directory):
+            holder['store'] = QuantizedStore(store_directory)
+        store = holder['store']
+    return store.search(query_embedding, k, allowed=allowed)
+
+
+def filter_sql(filters):
+    # Conditions on the metadata of question_answer, pushed down before the similarity search
+    conditions = []
+    params = []
+    for tag in filters.get('tags', []):
+        # tag_list holds the python list of the tags of the question, e.g. ['python', 'pandas']
+        conditions.append("CONTAINS(tag_list, ?)")
+        params.append("'" + tag + "'")
+    if filters.get('created_from') is not None:
+        conditions.append("creation_date >= ?")
+        params.append(filters['created_from'])
+    if filters.get('created_to') is not None:
+        conditions.append("creation_date < ?")
+        params.append(filters['created_to'])
+    if filters.get('min_score') is not None:
+        conditions.append("score >= ?")
+        params.append(filters['min_score'])
+    return conditions, params
+
+
+def retrieve_locally(query_embedding, retriever, conditions=(), params=(), allowed=None):
+    # The local retrievers do not hold the metadata : with filters, the results are filtered with the answers and the search
+    # is widened until num_chunks of them match, or until it returned everything it could (or max_filter_candidates results)
+    k = num_chunks * filter_overfetch if conditions else num_chunks
+    widen = 1
+    while True:
+        if retriever == "Quantized store":
+            answer_ids, similarities = search_store(query_embedding, k, allowed)
+        else:
+            answer_ids, similarities = search_index(query_embedding, k, allowed, widen)
+        if len(answer_ids) == 0:
+            return pd.DataFrame(columns=['QUESTION_BODY', 'ANSWER_BODY', 'QUESTION_ID'])
+
+        cmd = """
+        SELECT question_body, answer_body, question_id, answer_id
+        FROM question_answer
+        WHERE answer_id IN (SELECT value::NUMBER FROM TABLE(FLATTEN(input => PARSE_JSON(?))))
+        """
+        cmd += ''.join(" AND " + condition for condition in conditions)
+        df_context = session.sql(cmd, params=[json.dumps([int(answer_id) for answer_id in answer_ids])] + list(params)).to_pandas()
+        df_context = df_context.drop_duplicates('ANSWER_ID')
+
+        if len(df_context) >= num_chunks or not conditions or len(answer_ids) < k or k >= max_filter_candidates:
+            break
+        k = min(k * 4, max_filter_candidates)
+        widen *= 4
+
+    # Back to the order of the search results
+    rank = {int(answer_id): position for position, answer_id in enumerate(answer_ids)}
+    df_context = df_context.sort_values('ANSWER_ID', key=lambda ids: ids.map(rank)).drop(columns='ANSWER_ID')
+    return df_context.head(num_chunks).reset_index(drop=True)
+
+
+@st.cache_resource
+def get_retrieval_cache():
+    # Shared by every session of the app : query text -> embedding, and (query, num_chunks, retriever, filters, corpus version) -> context
+    return RetrievalCache()
+
+
+def read_corpus_version():
+    row = session.sql("SELECT COUNT(*) AS ROW_COUNT, TO_VARCHAR(MAX(UPDATED_AT)) AS LAST_UPDATE FROM question_answer").collect()[0]
+    return (row.ROW_COUNT, row.LAST_UPDATE)
+
+
+def embed_query(myquestion):
+    cache = get_retrieval_cache()
+    key = ('e5-base-v2', normalize_query(myquestion))
+    query_embedding = cache.embeddings.get(key)
+    if query_embedding is None:
+        query_embedding = session.sql("SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('e5-base-v2', ?) AS EMBEDDING", params=[myquestion]).collect()[0].EMBEDDING
+        query_embedding = [float(value) for value in (json.loads(query_embedding) if isinstance(query_embedding, str) else query_embedding)]
+        cache.embeddings.put(key, query_embedding)
+    return query_embedding
+
+
+def retrieve_context(myquestion, retriever, filters=None):
+    filters = filters or {}
+    cache = get_retrieval_cache()
+    key = (normalize_query(myquestion), num_chunks, retriever, json.dumps(filters, sort_keys=True), cache.corpus_version(read_corpus_version))
+    df_context = cache.results.get(key)
+    if df_context is not None:
+        return df_context.copy()
+
+    conditions, params = filter_sql(filters)
+    allowed = None
+    if filters.get('title_prefilter'):
+        candidates = search_titles(myquestion)
+        if len(candidates):
+            # Only the answers whose title matches the theme are ranked by vector similarity : an allow-list of the local retrievers,
+            # a condition of the Snowflake ones (without any match, the search is not filtered and create_prompt() says so)
+            allowed = [int(answer_id) for answer_id in candidates]
+            if retriever not in ("ANN index", "Quantized store"):
+                conditions.append("answer_id IN (SELECT value::NUMBER FROM TABLE(FLATTEN(input => PARSE_JSON(?))))")
+                params.append(json.dumps(allowed))
+    where = ("where " + " AND ".join(conditions)) if conditions else ""
+
+    query_embedding = embed_query(myquestion)
+    if retriever in ("ANN index", "Quantized store"):
+        df_context = retrieve_locally(query_embedding, retriever, conditions, params, allowed)
+    elif retriever == "Chunks":
+        # The chunk hits are collapsed back to posts : a post is ranked by its best chunk and only its matching chunks go to the prompt,
+        # with the title of its question instead of the whole bodies
+        chunk_filter = f"where answer_id in (SELECT answer_id FROM question_answer {where})" if conditions else ""
+        cmd = f"""
+        with hits as
+        (SELECT answer_id, chunk_no, chunk_text,
+            VECTOR_COSINE_SIMILARITY(chunk_embedding,
+                    PARSE_JSON(?)::ARRAY::VECTOR(FLOAT, 768)) as similarity
+        from question_answer_chunks
+        {chunk_filter}
+        order by similarity desc
+        limit ?),
+        posts as
+        (SELECT answer_id, MAX(similarity) as similarity,
+            LISTAGG(chunk_text, '\n...\n') WITHIN GROUP (ORDER BY chunk_no) as snippets
+        from hits
+        group by answer_id
+        order by similarity desc
+        limit ?)
+        select question_answer.title as question_body, posts.snippets as answer_body, question_answer.question_id
+        from posts join question_answer on question_answer.answer_id = posts.answer_id
+        order by posts.similarity desc
+        """
+        df_context = session.sql(cmd, params=[json.dumps(query_embedding)] + params + [num_chunks * chunk_hits_per_post, num_chunks]).to_pandas()
+    else:
+        cmd = f"""
+        with results as
+        (SELECT DISTINCT
+            QUESTION_ID,
+            VECTOR_COSINE_SIMILARITY(question_answer.question_answer_embedding,
+                    PARSE_JSON(?)::ARRAY::VECTOR(FLOAT, 768)) as similarity,
+            question_body, answer_body
+        from question_answer
+        {where}
+        order by similarity desc
+        limit ?)
+        select question_body, answer_body, question_id from results 
+        """
+        df_context = session.sql(cmd, params=[json.dumps(query_embedding)] + params + [num_chunks]).to_pandas()
+
+    cache.results.put(key, df_context.copy())
+    return df_context
+
+
+def pack_prompt_context(df_context, model, prompt_template):
+    # The posts are trimmed to the token budget left by the template and the newsletter in the context window of the model
+    posts = [{'question_body': row.QUESTION_BODY, 'answer_body': row.ANSWER_BODY, 'question_id': row.QUESTION_ID} for row in df_context.itertuples()]
+    budget = context_budget(model, estimate_tokens(prompt_template(""), model), max_context_tokens)
+    prompt_context, question_ids, report = pack_context(posts, model, budget)
+    return prompt_context.replace("'", ""), question_ids, report
+
+
+def theme_prompt(prompt_context):
+    return f"""
         Generate a StackOverflow Weekly Newsletter using the following structure:
         Start with this introduction:
         "Welcome to this issue of the StackOverflow Weekly Newsletter! This week, we explore some of the most engaging discussions in the programming community. Whether you're a seasoned developer or just starting out, we hope you find these insights both informative and inspiring."
@@ -53,6 +242,21 @@ def create_prompt(myquestion, rag, df_context=None):
         Avoid using explicit section headers like "Introduction," "Content," or "Conclusion." Ensure the content flows naturally as a single, unified piece of writing.
 
         """
+
+
+def create_prompt(myquestion, rag, df_context=None, retriever="Exact scan", model=None, filters=None):
+    report = None
+    question_ids = []
+    if rag == 1:    
+        if df_context is None:
+            df_context = retrieve_context(myquestion, retriever, filters)
+            if (filters or {}).get('title_prefilter') and len(search_titles(myquestion)) == 0:
+                st.info("No question title matches the theme : the title prefilter is not applied, every post is ranked by vector similarity.")
+            if len(df_context) < num_chunks:
+                st.info(f"Only {len(df_context)} of the {num_chunks} posts of the context match the filters.")
+
+        prompt_context, question_ids, report = pack_prompt_context(df_context, model, theme_prompt)
+        prompt = theme_prompt(prompt_context)
     else:
         prompt = f"""
         'Topic:  
@@ -60,36 +264,24 @@ def create_prompt(myquestion, rag, df_context=None):
         Newsletter: '
         """
 
-    return prompt, question_ids
+    if report is not None:
+        report['prompt_tokens'] = estimate_tokens(prompt, model)
+    return prompt, question_ids, report
 
 
 def get_top_questions():
     cmd = """
     SELECT QUESTION_BODY, ANSWER_BODY, QUESTION_ID
     FROM pfe2024.stackoverflow.stackoverflow_weekly
-    ORDER BY VIEW_COUNT DESC
+    ORDER BY VIEW_COUNT DESC NULLS LAST
     LIMIT 5
     """
     df_top_questions = session.sql(cmd).to_pandas()
     return df_top_questions
 
 
-def create_prompt2():
-    df_context = get_top_questions()
-    context_length = len(df_context)
-    prompt_context = ""
-    question_ids = []
-
-    for i in range(context_length):
-        prompt_context += df_context._get_value(i, 'QUESTION_BODY')
-        prompt_context += "\n"
-        prompt_context += df_context._get_value(i, 'ANSWER_BODY')
-        question_ids.append(df_context._get_value(i, 'QUESTION_ID'))
-
-    prompt_context = prompt_context.replace("'", "")
-
-
-    prompt = f"""
+def news_prompt(prompt_context):
+    return f"""
         Generate a StackOverflow Weekly Newsletter using the following structure:
         Start with this introduction:
         "Welcome to this issue of the StackOverflow Weekly Newsletter! This week, we explore some of the most engaging discussions in the programming community of stackoverflow that were posted during the last week. Whether you're a seasoned developer or just starting out, we hope you find these insights both informative and inspiring."
@@ -104,28 +296,61 @@ def create_prompt2():
         Avoid using explicit section headers like "Introduction," "Content," or "Conclusion." Ensure the content flows naturally as a single, unified piece of writing.
 
         """
-    
-    return prompt, question_ids
+
+
+def create_prompt2(model=None):
+    df_context = get_top_questions()
+    prompt_context, question_ids, report = pack_prompt_context(df_context, model, news_prompt)
+    prompt = news_prompt(prompt_context)
+    report['prompt_tokens'] = estimate_tokens(prompt, model)
+    return prompt, question_ids, report
     
 
-def complete(myquestion, model_name, mode, rag=1, df_context=None):
+def complete(myquestion, model_name, mode, rag=1, df_context=None, retriever="Exact scan", filters=None):
     if mode == "Theme-based":
-        prompt, question_ids = create_prompt(myquestion, rag, df_context)
+        prompt, question_ids, report = create_prompt(myquestion, rag, df_context, retriever, model_name, filters)
     else:
-        prompt, question_ids = create_prompt2()
-    cmd = f"""
-    select SNOWFLAKE.CORTEX.COMPLETE(?,?) as response
-    """
-    df_response = session.sql(cmd, params=[model_name, prompt]).collect()
-    return df_response, question_ids
+        prompt, question_ids, report = create_prompt2(model_name)
+
+    # Streamlit reruns the script on every interaction : a newsletter already generated for the same mode, theme, model and
+    # context questions is taken from the session state, then from the newsletters table, before calling the LLM again
+    key = newsletter_key(mode, myquestion, model_name, question_ids)
+    newsletters = st.session_state.setdefault('newsletters', {})
+    if key in newsletters:
+        return newsletters[key], question_ids, report
+
+    stored = session.sql("""
+    SELECT NEWSLETTER_BODY FROM pfe2024.stackoverflow.newsletters
+    WHERE CACHE_KEY = ?
+    ORDER BY CREATION_DATE DESC
+    LIMIT 1
+    """, params=[key]).collect()
+
+    if stored:
+        res_text = stored[0].NEWSLETTER_BODY
+    else:
+        cmd = f"""
+        select SNOWFLAKE.CORTEX.COMPLETE(?,?) as response
+        """
+        df_response = session.sql(cmd, params=[model_name, prompt]).collect()
+        res_text = df_response[0].RESPONSE
+        session.sql(f"""
+        INSERT INTO pfe2024.stackoverflow.newsletters (query, model, creation_date, newsletter_body, mode, context_question_ids, cache_key)
+        VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?, ?, ?);
+        """, params=[myquestion, model_name, res_text, mode, ','.join(str(question_id) for question_id in question_ids), key]).collect()
+
+    newsletters[key] = res_text
+    return res_text, question_ids, report
 
-def display_response(question, model, mode, rag=0, df_context=None):
-    response, question_ids = complete(question, model, mode, rag, df_context)
-    res_text = response[0].RESPONSE
+def display_response(question, model, mode, rag=0, df_context=None, retriever="Exact scan", filters=None):
+    res_text, question_ids, report = complete(question, model, mode, rag, df_context, retriever, filters)
     st.markdown(res_text)
     st.markdown("Relevant questions:")
     st.markdown(question_ids)
-    return response
+    if report is not None:
+        st.caption(f"Prompt : ~{report['prompt_tokens']} tokens, context : ~{report['context_tokens']} / {report['budget']} tokens "
+                   f"({report['posts']} posts, {report['trimmed_bodies']} bodies trimmed)")
+    return res_text
 
 
 
@@ -147,22 +372,38 @@ model = st.sidebar.selectbox('Select your model:',(
                                      'llama2-70b-chat',
                                      'gemma-7b'))
 
+# Exact scan : VECTOR_COSINE_SIMILARITY over every row in Snowflake, ANN index : local IVF index of the exported embeddings (vector_index.py),
+# Quantized store : binary coarse pass + exact rerank over a memory-mapped export of the embeddings (quantized_store.py),
+# Chunks : VECTOR_COSINE_SIMILARITY over the chunk embeddings of question_answer_chunks, only the matching snippets of each post are used
+retriever = st.sidebar.selectbox('Select the retriever:', ("Exact scan", "ANN index", "Quantized store", "Chunks"))
+
+# Optional filters of the theme-based mode, applied to the metadata of question_answer before the similarity search
+filters = {}
+tags = st.sidebar.text_input('Tags (comma separated):', placeholder="Ex: python, pandas")
+filters['tags'] = sorted({tag.strip().lower() for tag in tags.split(',') if tag.strip()})
+if st.sidebar.checkbox('Filter by creation date'):
+    today = datetime.date.today()
+    dates = st.sidebar.date_input('Created between:', (today - datetime.timedelta(days=365), today))
+    if len(dates) == 2:
+        filters['created_from'] = int(datetime.datetime.combine(dates[0], datetime.time(), datetime.timezone.utc).timestamp())
+        filters['created_to'] = int(datetime.datetime.combine(dates[1] + datetime.timedelta(days=1), datetime.time(), datetime.timezone.utc).timestamp())
+if st.sidebar.checkbox('Filter by score'):
+    filters['min_score'] = int(st.sidebar.number_input('Minimum score:', value=1, step=1))
+# BM25 over the question titles (lexical_index.py), its best matches are reranked by vector similarity
+filters['title_prefilter'] = st.sidebar.checkbox('Title prefilter (BM25)')
+if retriever in ("ANN index", "Quantized store"):
+    st.sidebar.caption(f"The {retriever.lower()} holds no metadata : the tag, date and score filters are applied to its results, "
+                       f"and the search is widened until enough posts match (up to {max_filter_candidates} results). "
+                       "The title prefilter restricts the search to the matching titles.")
+
 response = None
 
 if generation_type == "Theme-based":
     question = st.text_input("Enter the theme of the newsletter", placeholder="Ex: classification with data imbalance", label_visibility="collapsed")
 
     if question:
-        response = display_response(question, model, mode="Theme-based", rag=1)
-        session.sql(f"""
-        INSERT INTO pfe2024.stackoverflow.newsletters (query, model, creation_date, newsletter_body)
-        VALUES (?, ?, CURRENT_TIMESTAMP, ?);
-        """, params=[question, model, response[0].RESPONSE]).collect()
+        response = display_response(question, model, mode="Theme-based", rag=1, retriever=retriever, filters=filters)
 
 elif generation_type == "News-based":
         
         response = display_response("Latest Top Questions", model, "News-based", rag=1)
-        session.sql(f"""
-        INSERT INTO pfe2024.stackoverflow.newsletters (query, model, creation_date, newsletter_body)
-        VALUES (?, ?, CURRENT_TIMESTAMP, ?);
-        """, params=["Latest Top Questions", model, response[0].RESPONSE]).collect()
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+from vector_index import IVFIndex, to_matrix
+from quantized_store import QuantizedStore, build_store, STORE_FILES
+
+
+"""
+Recall/latency benchmark of the IVF index and of the quantized store against the exact scan (the VECTOR_COSINE_SIMILARITY of RAG.py)
+
+Usage : python3 bench_retrieval.py [number_of_vectors] [k] [embeddings.npz]
+
+Process :
+    - Uses the vectors of an export of question_answer (npz file with 'ids' and 'vectors', e.g. saved by IVFIndex.save())
+      or synthetic clustered 768-d vectors
+    - Times the exact scan and the IVF search for several n_probe values over the same queries
+    - Reports recall@k (share of the exact top-k found by the index) and the mean latency per query
+    - Times an incremental refresh (add()) of 1% new vectors
+    - Does the same for the binary coarse pass of the quantized store, and reports the size of its files
+"""
+
+def synthetic_vectors(n, dim=768, clusters=200, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    return np.arange(n), vectors
+
+
+def timed_searches(search, queries):
+    t0 = time.perf_counter()
+    results = [search(query) for query in queries]
+    return results, (time.perf_counter() - t0) / len(queries) * 1000
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    if len(sys.argv) > 3:
+        data = np.load(sys.argv[3])
+        ids, vectors = data['ids'][:n], data['vectors'][:n]
+    else:
+        ids, vectors = synthetic_vectors(n)
+    print(f"{len(ids)} vectors of dimension {vectors.shape[1]}, top {k}\n")
+
+    rng = np.random.default_rng(1)
+    queries = to_matrix(vectors[rng.choice(len(vectors), 200, replace=False)]) + 0.05 * rng.normal(size=(200, vectors.shape[1])).astype(np.float32)
+
+    t0 = time.perf_counter()
+    index = IVFIndex().build(ids, vectors)
+    print(f"build : {time.perf_counter() - t0:.2f} s, {len(index.centroids)} lists\n")
+
+    exact, exact_ms = timed_searches(lambda query: index.exact_search(query, k)[0], queries)
+    print(f"{'exact scan':<16} {exact_ms:8.2f} ms/query   recall@{k} 1.000")
+
+    for n_probe in (1, 4, 8, 16, 32):
+        found, ms = timed_searches(lambda query: index.search(query, k, n_probe)[0], queries)
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, exact)])
+        print(f"{'ivf n_probe=' + str(n_probe):<16} {ms:8.2f} ms/query   recall@{k} {recall:.3f}")
+
+    new_ids, new_vectors = synthetic_vectors(max(1, len(ids) // 100), vectors.shape[1], seed=2)
+    t0 = time.perf_counter()
+    index.add(new_ids + int(ids.max()) + 1, new_vectors)
+    print(f"\nincremental refresh of {len(new_ids)} vectors : {(time.perf_counter() - t0) * 1000:.1f} ms\n")
+
+    with tempfile.TemporaryDirectory() as directory:
+        build_store(directory + '/store', ids, vectors)
+        store = QuantizedStore(directory + '/store')
+        bytes_per_vector = store.binary.nbytes / len(store)
+        for candidates in (20, 100, 400):
+            found, ms = timed_searches(lambda query: store.search(query, k, candidates)[0], queries)
+            recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, exact)])
+            print(f"{'binary c=' + str(candidates):<16} {ms:8.2f} ms/query   recall@{k} {recall:.3f}   {bytes_per_vector:.0f} bytes/vector scanned")
+
+        # The float32 vectors of the rerank make most of the store on disk
+        sizes = {name: os.path.getsize(os.path.join(store.directory, name + '.npy')) for name in STORE_FILES}
+        print("\nstore files : " + ', '.join(f"{name} {size / 2**20:.1f} MB" for name, size in sizes.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import re
+import math
+
+
+# Context window (in tokens) of the models of the app
+MODEL_CONTEXT_WINDOWS = {
+    'mixtral-8x7b': 32000,
+    'snowflake-arctic': 4096,
+    'mistral-large': 32000,
+    'llama3-8b': 8000,
+    'llama3-70b': 8000,
+    'reka-flash': 100000,
+    'mistral-7b': 32000,
+    'llama2-70b-chat': 4096,
+    'gemma-7b': 8000
+}
+
+# Average number of characters per token of the tokenizer of each model family (StackOverflow text, code included)
+CHARS_PER_TOKEN = {
+    'llama3': 3.8,
+    'llama2': 3.3,
+    'mistral': 3.3,
+    'mixtral': 3.3,
+    'gemma': 3.8,
+    'snowflake-arctic': 3.5,
+    'reka': 3.5
+}
+DEFAULT_CHARS_PER_TOKEN = 3.3
+
+# Tokens kept free for the generated newsletter
+OUTPUT_TOKENS = 1500
+
+# Fenced code blocks and indented code blocks (4 spaces or a tab)
+CODE_BLOCK = re.compile(r'^[ \t]*(```|~~~)[^\n]*\n.*?^[ \t]*\1[ \t]*$|(?:^(?: {4}|\t)[^\n]*(?:\n|$))+', re.MULTILINE | re.DOTALL)
+
+
+"""
+Estimates the number of tokens of a text for a model, from the average number of characters per token of its family
+"""
+
+def estimate_tokens(text, model=None):
+    chars_per_token = DEFAULT_CHARS_PER_TOKEN
+    for family, value in CHARS_PER_TOKEN.items():
+        if model and model.startswith(family):
+            chars_per_token = value
+            break
+    return int(math.ceil(len(text or '') / chars_per_token))
+
+
+"""
+Returns the token budget of the context of a prompt : what the context window of the model leaves once the prompt template
+and the generated newsletter are accounted for, capped by max_tokens if it is given
+"""
+
+def context_budget(model, template_tokens=0, max_tokens=None):
+    budget = MODEL_CONTEXT_WINDOWS.get(model, 4096) - OUTPUT_TOKENS - template_tokens
+    if max_tokens is not None:
+        budget = min(budget, max_tokens)
+    return max(budget, 0)
+
+
+"""
+Splits a body into its blocks (paragraphs and code blocks), returns a list of (text, is_code)
+"""
+
+def split_blocks(text):
+    blocks = []
+    position = 0
+    for match in CODE_BLOCK.finditer(text):
+        blocks += [(paragraph, False) for paragraph in re.split(r'\n\s*\n', text[position:match.start()]) if paragraph.strip()]
+        blocks.append((match.group(0).strip('\n'), True))
+        position = match.end()
+    blocks += [(paragraph, False) for paragraph in re.split(r'\n\s*\n', text[position:]) if paragraph.strip()]
+    return blocks
+
+
+# Separator of the kept blocks of a trimmed body, and mark of a cut block
+BLOCK_SEPARATOR = '\n\n'
+CUT_MARK = ' ...'
+
+
+"""
+Trims a body to a token budget :
+    - The code blocks come first (they are what a StackOverflow answer is about), then the prose in its original order
+    - A block that does not fit is cut at the budget (a code block is only cut if no other block was kept), the kept blocks stay in their original order
+    - Every kept block is counted with its separator and a cut block with its cut mark, so the trimmed body never exceeds the budget
+"""
+
+def trim_body(text, budget, model=None):
+    text = text or ''
+    if estimate_tokens(text, model) <= budget:
+        return text, False
+
+    blocks = split_blocks(text)
+    order = sorted(range(len(blocks)), key=lambda i: not blocks[i][1])
+    kept = {}
+    remaining = budget
+    for i in order:
+        block, is_code = blocks[i]
+        tokens = estimate_tokens(block + BLOCK_SEPARATOR, model)
+        if tokens <= remaining:
+            kept[i] = block
+            remaining -= tokens
+        elif remaining > 20 and (not is_code or not kept):
+            text_tokens = remaining - estimate_tokens(CUT_MARK + BLOCK_SEPARATOR, model)
+            chars = int(text_tokens * len(block) / max(estimate_tokens(block, model), 1))
+            kept[i] = block[:chars].rstrip() + CUT_MARK
+            remaining = 0
+    return BLOCK_SEPARATOR.join(kept[i] for i in sorted(kept)), True
+
+
+"""
+Splits a token budget between posts of the given sizes : the posts shorter than an equal share keep their full size
+and leave the rest of their share to the longer posts
+"""
+
+def share_budget(sizes, budget):
+    shares = [0] * len(sizes)
+    remaining = budget
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for position, i in enumerate(order):
+        shares[i] = min(sizes[i], remaining // (len(sizes) - position))
+        remaining -= shares[i]
+    return shares
+
+
+"""
+Packs the retrieved posts into the context of a prompt within a token budget
+
+Input :
+    - posts : list of dicts with the question_body, answer_body and question_id of each post, best post first
+    - model : the model the prompt is sent to (tokens are estimated for its tokenizer)
+    - budget : number of tokens of the context (see context_budget())
+    - answer_share : share of the budget of a post given to its accepted answer, the rest goes to the question
+
+Process :
+    - The budget is split between the posts with share_budget()
+    - The question and the answer of a post are trimmed to their shares with trim_body(), the part of the share that one side
+      does not need goes to the other one
+    - The separators of the posts are counted in the budget, and the context is cut at the budget if the estimates still exceed it,
+      so budget is a hard cap
+    - Returns the context, the question ids of the packed posts and a report (tokens used, budget, number of posts and of trimmed bodies)
+"""
+
+def pack_context(posts, model, budget, answer_share=0.6):
+    parts = []
+    question_ids = []
+    trimmed = 0
+
+    sizes = [estimate_tokens(post['question_body'], model) + estimate_tokens(post['answer_body'], model) for post in posts]
+    # The separators of every post ("\n" between its question and its answer, "\n\n" before the next post) are kept out of the shares
+    separator_tokens = estimate_tokens("\n\n\n", model)
+    for post, share in zip(posts, share_budget(sizes, max(budget - separator_tokens * len(posts), 0))):
+        if share <= 0:
+            continue
+
+        question_tokens = estimate_tokens(post['question_body'], model)
+        answer_tokens = estimate_tokens(post['answer_body'], model)
+        answer_budget = max(int(share * answer_share), share - question_tokens)
+        question_budget = max(share - answer_budget, share - answer_tokens)
+
+        question, question_trimmed = trim_body(post['question_body'], question_budget, model)
+        answer, answer_trimmed = trim_body(post['answer_body'], share - estimate_tokens(question, model), model)
+        trimmed += question_trimmed + answer_trimmed
+
+        parts.append(question + "\n" + answer)
+        question_ids.append(post['question_id'])
+
+    context = "\n\n".join(parts)
+    if estimate_tokens(context, model) > budget:
+        context = context[:len(context) * budget // estimate_tokens(context, model)].rstrip()
+    report = {
+        'context_tokens': estimate_tokens(context, model),
+        'budget': budget,
+        'posts': len(question_ids),
+        'trimmed_bodies': trimmed
+    }
+    return context, question_ids, report
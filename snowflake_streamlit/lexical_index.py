@@ -0,0 +1,138 @@
+import re
+import math
+import time
+import numpy as np
+from collections import Counter, defaultdict
+
+
+# Words of a title, keeping the characters of names such as c++, c#, node.js or scikit-learn
+TOKEN = re.compile(r"[a-z0-9][a-z0-9+#._-]*")
+STOPWORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'does', 'for', 'from', 'how', 'i', 'in', 'is', 'it',
+             'my', 'of', 'on', 'or', 'the', 'this', 'to', 'what', 'when', 'why', 'with'}
+
+
+"""
+Splits a text into lower case terms without the stop words
+"""
+
+def tokenize(text):
+    terms = [term.rstrip('._-') for term in TOKEN.findall(str(text or '').lower())]
+    return [term for term in terms if term and term not in STOPWORDS]
+
+
+"""
+BM25 index of the question titles, the lexical prefilter of the RAG app
+
+Input :
+    - k1 : saturation of the term frequency
+    - b : normalization of the title length
+
+Process :
+    - add() indexes the titles of answer ids (an id added again replaces its previous title), so the index can follow the rows
+      that land in question_answer, see refresh()
+    - search() scores the titles that contain at least one term of the query and returns the ids and BM25 scores of the k best ones,
+      the candidates that the app reranks by vector similarity
+"""
+
+class BM25Index:
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids = []
+        self.lengths = []
+        self.alive = []
+        self.positions = {}
+        self.postings = defaultdict(list)
+        self.watermark = None
+        self.refreshed_at = None
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, ids, titles):
+        for id_value, title in zip(ids, titles):
+            # An updated row replaces its previous title
+            position = self.positions.get(int(id_value))
+            if position is not None:
+                self.alive[position] = False
+
+            document = len(self.ids)
+            terms = tokenize(title)
+            for term, frequency in Counter(terms).items():
+                self.postings[term].append((document, frequency))
+            self.ids.append(int(id_value))
+            self.lengths.append(len(terms))
+            self.alive.append(True)
+            self.positions[int(id_value)] = document
+
+        # The numpy views of the index are built again on the next search
+        self._arrays = {}
+        return self
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.asarray(getattr(self, name))
+        return self._arrays[name]
+
+    def posting(self, term):
+        # (document, term frequency) rows of the titles that contain the term
+        key = ('posting', term)
+        if key not in self._arrays:
+            self._arrays[key] = np.asarray(self.postings[term], dtype=np.int64).reshape(-1, 2)
+        return self._arrays[key]
+
+    def search(self, query, k=500):
+        terms = [term for term in set(tokenize(query)) if term in self.postings]
+        if not terms or not self.positions:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        alive = self.array('alive')
+        lengths = self.array('lengths').astype(np.float32)
+        documents = alive.sum()
+        norm = self.k1 * (1 - self.b + self.b * lengths / max(lengths[alive].mean(), 1))
+
+        scores = np.zeros(len(alive), dtype=np.float32)
+        for term in terms:
+            posting = self.posting(term)
+            matches, frequencies = posting[:, 0], posting[:, 1]
+            idf = math.log(1 + (documents - len(matches) + 0.5) / (len(matches) + 0.5))
+            scores[matches] += idf * frequencies * (self.k1 + 1) / (frequencies + norm[matches])
+        scores[~alive] = 0
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return self.array('ids')[candidates], scores[candidates]
+
+
+"""
+Builds the BM25 index of the titles of question_answer, or brings an existing index up to date with the rows updated since its last refresh
+(an index without watermark, e.g. when every UPDATED_AT is NULL, is built again from scratch instead of adding every title again)
+"""
+
+def refresh(session, index=None, **options):
+    if index is None:
+        index = BM25Index(**options)
+    elif index.watermark is None:
+        index = BM25Index(index.k1, index.b)
+
+    cmd = """
+    SELECT ANSWER_ID, TITLE, TO_VARCHAR(UPDATED_AT) AS UPDATED_AT
+    FROM question_answer
+    """
+    params = []
+    if index.watermark is not None:
+        cmd += " WHERE UPDATED_AT > TO_TIMESTAMP_NTZ(?)"
+        params.append(index.watermark)
+
+    df = session.sql(cmd, params=params).to_pandas()
+    if len(df):
+        index.add(df['ANSWER_ID'].to_list(), df['TITLE'].to_list())
+        watermark = df['UPDATED_AT'].dropna().max()
+        if isinstance(watermark, str):
+            index.watermark = watermark
+    index.refreshed_at = time.time()
+    return index
@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from vector_index import to_matrix, export_embeddings
+
+
+# Number of set bits of every byte value, for the hamming distance of the binary codes (numpy < 2.0 has no bitwise_count)
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+bitwise_count = getattr(np, 'bitwise_count', lambda codes: POPCOUNT[codes])
+
+# Files of a store directory, every one is a .npy array that is memory-mapped by QuantizedStore : the float32 vectors of the rerank
+# (3072 bytes per vector) make most of its size on disk, the binary codes of the coarse pass only add 96 bytes per vector
+STORE_FILES = ('ids', 'vectors', 'binary')
+
+
+"""
+Quantizes unit vectors to binary codes : the sign of every component, 8 components per byte
+(an int8 coarse pass was dropped : numpy has no integer matrix product faster than the float32 one of the exact scan)
+"""
+
+def quantize(matrix):
+    return np.packbits(matrix > 0, axis=-1)
+
+
+"""
+Writes a store directory from answer ids and their embeddings :
+    - the files are written to a new directory with a unique name next to directory, so concurrent builds never share files
+    - directory is a symlink that is switched to the new directory at once (os.replace of a symlink is atomic), the app workers
+      that map the store never see a partial one and notice the switch through store_identity()
+    - the previous directory is deleted, the processes that still map it keep their mapping until they reopen the store
+"""
+
+def build_store(directory, ids, vectors):
+    matrix = to_matrix(vectors)
+    arrays = {
+        'ids': np.asarray(ids, dtype=np.int64),
+        'vectors': matrix,
+        'binary': quantize(matrix)
+    }
+
+    directory = os.path.abspath(directory.rstrip('/'))
+    parent, name = os.path.split(directory)
+    os.makedirs(parent, exist_ok=True)
+    new_directory = tempfile.mkdtemp(prefix=name + '.', dir=parent)
+    for store_file in STORE_FILES:
+        np.save(os.path.join(new_directory, store_file + '.npy'), arrays[store_file])
+
+    # A store written before the symlink swap is a plain directory, it is replaced once
+    if os.path.isdir(directory) and not os.path.islink(directory):
+        shutil.rmtree(directory)
+    old_directory = os.path.realpath(directory) if os.path.islink(directory) else None
+
+    link = new_directory + '.link'
+    os.symlink(os.path.basename(new_directory), link)
+    os.replace(link, directory)
+    if old_directory is not None and old_directory != new_directory:
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+
+"""
+Returns the identity (inode and modification time) of the store directory currently behind directory, None if there is none
+"""
+
+def store_identity(directory):
+    try:
+        stat = os.stat(directory)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+"""
+Exports the embeddings of question_answer into a store directory
+"""
+
+def export_store(session, directory):
+    ids, vectors, watermark = export_embeddings(session)
+    build_store(directory, ids, vectors)
+    return watermark
+
+
+"""
+On-disk embedding store, memory-mapped so that loading it copies nothing and every process that maps the same directory
+shares one copy in the page cache : a search scans 96 bytes per vector instead of 3072, but the store is not smaller on disk
+than the embeddings since it keeps their float32 vectors for the rerank (see STORE_FILES)
+
+Input :
+    - directory : the store directory written by build_store() or export_store()
+    - candidates : number of vectors kept by the coarse pass and reranked with their exact cosine similarity
+    - chunk_size : number of vectors scanned at once by the coarse pass (bounds the memory of a search)
+
+Process :
+    - search() runs the coarse pass (hamming distance of the binary codes) over every vector, keeps the best candidates, then reads
+      only their float vectors to rerank them with the exact cosine similarity, and returns the top-k ids and similarities
+      (with an allow-list of ids, only their float vectors are scored)
+    - exact_search() scans every float vector (the reference of the benchmark)
+"""
+
+class QuantizedStore:
+
+    def __init__(self, directory, candidates=200, chunk_size=16384):
+        # The store directory behind the symlink, so every file comes from the same build
+        self.directory = os.path.realpath(directory)
+        self.identity = store_identity(self.directory)
+        self.candidates = candidates
+        self.chunk_size = chunk_size
+
+        for name in STORE_FILES:
+            setattr(self, name, np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def coarse_scores(self, coarse_query, start, end):
+        # The fewer differing sign bits, the closer : the score is minus the hamming distance
+        return -bitwise_count(np.bitwise_xor(self.binary[start:end], coarse_query)).sum(axis=1, dtype=np.int32)
+
+    def top(self, scores, k):
+        if len(scores) <= k:
+            return np.argsort(-scores)
+        best = np.argpartition(-scores, k)[:k]
+        return best[np.argsort(-scores[best])]
+
+    def search(self, query, k=5, candidates=None, allowed=None):
+        query = to_matrix([query])[0]
+        if allowed is not None:
+            # Only the vectors of the allowed ids are reranked, e.g. the titles kept by the BM25 prefilter
+            rows = np.flatnonzero(np.isin(self.ids, np.asarray(allowed, dtype=np.int64)))
+            similarities = self.vectors[rows] @ query
+            best = self.top(similarities, k)
+            return np.asarray(self.ids[rows[best]]), similarities[best]
+
+        candidates = max(k, candidates or self.candidates)
+
+        # Coarse pass, chunk by chunk, keeping the best candidates of each chunk
+        coarse_query = quantize(query)
+        kept = []
+        kept_scores = []
+        for start in range(0, len(self.ids), self.chunk_size):
+            end = min(start + self.chunk_size, len(self.ids))
+            scores = self.coarse_scores(coarse_query, start, end)
+            best = self.top(scores, candidates)
+            kept.append(best + start)
+            kept_scores.append(scores[best])
+        if not kept:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        kept = np.concatenate(kept)
+        kept = kept[self.top(np.concatenate(kept_scores).astype(np.float32), candidates)]
+
+        # Exact rerank of the candidates only
+        kept = np.sort(kept)
+        similarities = self.vectors[kept] @ query
+        best = self.top(similarities, k)
+        return np.asarray(self.ids[kept[best]]), similarities[best]
+
+    def exact_search(self, query, k=5):
+        query = to_matrix([query])[0]
+        similarities = np.concatenate([self.vectors[start:start + self.chunk_size] @ query for start in range(0, len(self.ids), self.chunk_size)])
+        best = self.top(similarities, k)
+        return np.asarray(self.ids[best]), similarities[best]
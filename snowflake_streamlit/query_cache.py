@@ -0,0 +1,109 @@
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+"""
+Normalizes a theme typed in the app so that the same theme written differently (case, spaces) hits the same cache entries
+"""
+
+def normalize_query(text):
+    return ' '.join(str(text).lower().split())
+
+
+"""
+Thread-safe cache with LRU eviction and a time to live
+
+Input :
+    - max_size : number of entries kept, the least recently used entry is evicted first
+    - ttl : number of seconds an entry stays valid
+
+Process :
+    - get() returns the value of a key (or None if it is missing or expired) and marks it as recently used
+    - put() adds or replaces an entry and evicts the least recently used entries beyond max_size
+    - clear() drops every entry (e.g. when the corpus changed), hits and misses count the lookups
+"""
+
+class TTLCache:
+
+    def __init__(self, max_size=1000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+"""
+Two-level cache of the retrieval step of the RAG app
+
+Input :
+    - embeddings : TTLCache of the query embeddings, keyed by (model, normalized query)
+    - results : TTLCache of the retrieved context, keyed by (normalized query, number of chunks, retriever, corpus version)
+    - version_check_seconds : the corpus version is read from question_answer at most this often
+
+Process :
+    - An embedding does not depend on the corpus, it stays valid until its ttl
+    - The retrieved context depends on the corpus : the results are cleared as soon as the corpus version
+      (number of rows and last UPDATED_AT of question_answer) changes
+"""
+
+class RetrievalCache:
+
+    def __init__(self, embeddings=None, results=None, version_check_seconds=60):
+        self.embeddings = embeddings if embeddings is not None else TTLCache(max_size=5000, ttl=7 * 86400)
+        self.results = results if results is not None else TTLCache(max_size=1000, ttl=3600)
+        self.version_check_seconds = version_check_seconds
+        self.version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def corpus_version(self, read_version):
+        # read_version : function that returns the current version of the corpus
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at > self.version_check_seconds:
+                version = read_version()
+                if version != self.version:
+                    self.results.clear()
+                    self.version = version
+                self._checked_at = now
+            return self.version
+
+
+"""
+Key of a generated newsletter : the same mode, theme (normalized), model and context questions give the same newsletter
+"""
+
+def newsletter_key(mode, theme, model, question_ids):
+    key = json.dumps([mode, normalize_query(theme), model, [str(question_id) for question_id in question_ids]])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
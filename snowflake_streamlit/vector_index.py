@@ -0,0 +1,221 @@
+import time
+import json
+import numpy as np
+
+
+"""
+Converts the vectors returned by Snowflake (lists, arrays or json strings depending on the client) into a float32 matrix
+with one unit-norm row per vector, so that the dot product is the cosine similarity
+"""
+
+def to_matrix(vectors):
+    matrix = np.asarray([json.loads(v) if isinstance(v, str) else v for v in vectors], dtype=np.float32)
+    if matrix.ndim != 2:
+        matrix = matrix.reshape(len(vectors), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+"""
+Spherical k-means used to train the IVF centroids, runs on a sample of the vectors
+"""
+
+def train_centroids(matrix, n_lists, iterations=10, sample_size=50000, seed=0):
+    rng = np.random.default_rng(seed)
+    sample = matrix[rng.choice(len(matrix), min(sample_size, len(matrix)), replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for list_no in range(n_lists):
+            members = sample[assignment == list_no]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[list_no] = centroid / (np.linalg.norm(centroid) or 1)
+    return centroids
+
+
+"""
+Approximate nearest neighbour index (IVF : inverted file over k-means centroids) of the question/answer embeddings
+
+Input :
+    - n_lists : number of centroids (inverted lists), about sqrt(number of vectors) when None
+    - n_probe : number of lists scanned by a search, the recall/latency trade-off
+    - rebuild_factor : the centroids are trained again once the index grew by this factor since the last build
+
+Process :
+    - build() normalizes the vectors, trains the centroids and puts every vector in the list of its nearest centroid
+    - search() scores the centroids, scans the vectors of the n_probe best lists only and returns the top-k ids and cosine similarities,
+      or only scores the vectors of the allowed ids when an allow-list is given
+    - exact_search() scans every vector (the reference of the benchmark)
+    - add() inserts new or updated vectors without rebuilding (an updated id replaces its previous vector), so the index can follow
+      the rows that land in question_answer, see refresh()
+    - save() / load() keep the index in a .npz file
+"""
+
+class IVFIndex:
+
+    def __init__(self, n_lists=None, n_probe=8, rebuild_factor=2.0, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.rebuild_factor = rebuild_factor
+        self.seed = seed
+
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.centroids = None
+        self.assignment = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.lists = []
+        self.positions = {}
+        self.built_size = 0
+        self.watermark = None
+        self.refreshed_at = None
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def build(self, ids, vectors):
+        matrix = to_matrix(vectors)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(matrix))))
+        n_lists = min(n_lists, len(matrix))
+
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.vectors = matrix
+        self.centroids = train_centroids(matrix, n_lists, seed=self.seed)
+        self.assignment = self.assign(matrix)
+        self.alive = np.ones(len(matrix), dtype=bool)
+        self.positions = {int(id_value): position for position, id_value in enumerate(self.ids)}
+        self.built_size = len(matrix)
+        self.make_lists()
+        return self
+
+    def assign(self, matrix):
+        assignment = np.empty(len(matrix), dtype=np.int64)
+        for i in range(0, len(matrix), 10000):
+            assignment[i:i + 10000] = np.argmax(matrix[i:i + 10000] @ self.centroids.T, axis=1)
+        return assignment
+
+    def make_lists(self):
+        order = np.argsort(self.assignment, kind='stable')
+        order = order[self.alive[order]]
+        bounds = np.searchsorted(self.assignment[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def add(self, ids, vectors):
+        if self.centroids is None or len(self) == 0:
+            return self.build(ids, vectors)
+
+        matrix = to_matrix(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+
+        # An updated row replaces its previous vector
+        for id_value in ids:
+            position = self.positions.get(int(id_value))
+            if position is not None:
+                self.alive[position] = False
+
+        start = len(self.ids)
+        self.ids = np.concatenate([self.ids, ids])
+        self.vectors = np.vstack([self.vectors, matrix])
+        self.assignment = np.concatenate([self.assignment, self.assign(matrix)])
+        self.alive = np.concatenate([self.alive, np.ones(len(matrix), dtype=bool)])
+        for offset, id_value in enumerate(ids):
+            self.positions[int(id_value)] = start + offset
+
+        if len(self.ids) >= self.rebuild_factor * self.built_size:
+            # The centroids no longer represent the data, train them again on the live vectors
+            self.build(self.ids[self.alive], self.vectors[self.alive])
+        else:
+            self.make_lists()
+        return self
+
+    def top_k(self, candidates, scores, k):
+        if len(candidates) > k:
+            best = np.argpartition(-scores, k)[:k]
+            candidates, scores = candidates[best], scores[best]
+        order = np.argsort(-scores)
+        return self.ids[candidates[order]], scores[order]
+
+    def search(self, query, k=5, n_probe=None, allowed=None):
+        query = to_matrix([query])[0]
+        if allowed is not None:
+            # Only the vectors of the allowed ids are scored (exactly, whatever their list), e.g. the titles kept by the BM25 prefilter
+            candidates = np.asarray([self.positions[int(id_value)] for id_value in allowed if int(id_value) in self.positions], dtype=np.int64)
+            return self.top_k(candidates, self.vectors[candidates] @ query, k)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        probed = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        candidates = np.concatenate([self.lists[list_no] for list_no in probed])
+        return self.top_k(candidates, self.vectors[candidates] @ query, k)
+
+    def exact_search(self, query, k=5):
+        query = to_matrix([query])[0]
+        candidates = np.flatnonzero(self.alive)
+        return self.top_k(candidates, self.vectors[candidates] @ query, k)
+
+    def save(self, path):
+        np.savez(path, ids=self.ids[self.alive], vectors=self.vectors[self.alive], centroids=self.centroids,
+                 params=np.array([self.n_probe, self.rebuild_factor, self.seed]), watermark=np.array([str(self.watermark)]))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        n_probe, rebuild_factor, seed = data['params']
+        index = cls(n_lists=len(data['centroids']), n_probe=int(n_probe), rebuild_factor=float(rebuild_factor), seed=int(seed))
+        index.ids = data['ids']
+        index.vectors = data['vectors']
+        index.centroids = data['centroids']
+        index.assignment = index.assign(index.vectors)
+        index.alive = np.ones(len(index.ids), dtype=bool)
+        index.positions = {int(id_value): position for position, id_value in enumerate(index.ids)}
+        index.built_size = len(index.ids)
+        watermark = str(data['watermark'][0])
+        index.watermark = None if watermark == 'None' else watermark
+        index.make_lists()
+        return index
+
+
+"""
+Exports the embeddings of question_answer (all of them, or only the rows updated after the watermark)
+and returns (answer ids, embeddings, new watermark)
+"""
+
+def export_embeddings(session, watermark=None):
+    cmd = """
+    SELECT ANSWER_ID, QUESTION_ANSWER_EMBEDDING, TO_VARCHAR(UPDATED_AT) AS UPDATED_AT
+    FROM question_answer
+    WHERE QUESTION_ANSWER_EMBEDDING IS NOT NULL
+    """
+    params = []
+    if watermark is not None:
+        cmd += " AND UPDATED_AT > TO_TIMESTAMP_NTZ(?)"
+        params.append(watermark)
+
+    df = session.sql(cmd, params=params).to_pandas()
+    new_watermark = df['UPDATED_AT'].dropna().max() if len(df) else None
+    if new_watermark is None or (isinstance(new_watermark, float) and np.isnan(new_watermark)):
+        new_watermark = watermark
+    return df['ANSWER_ID'].to_numpy(), df['QUESTION_ANSWER_EMBEDDING'].to_list(), new_watermark
+
+
+"""
+Builds the index of question_answer, or brings an existing index up to date with the rows updated since its last refresh
+(an index without watermark, e.g. when every UPDATED_AT is NULL, is built again from scratch instead of adding every row again)
+"""
+
+def refresh(session, index=None, **options):
+    if index is None or index.centroids is None or index.watermark is None:
+        ids, vectors, watermark = export_embeddings(session)
+        if index is not None:
+            options = {**dict(n_lists=index.n_lists, n_probe=index.n_probe, rebuild_factor=index.rebuild_factor, seed=index.seed), **options}
+        index = IVFIndex(**options)
+        if len(ids):
+            index.build(ids, vectors)
+    else:
+        ids, vectors, watermark = export_embeddings(session, index.watermark)
+        if len(ids):
+            index.add(ids, vectors)
+    index.watermark = watermark
+    index.refreshed_at = time.time()
+    return index